@@ -0,0 +1,260 @@
+'''
+Local stand-in of the EET gateway for benchmarks
+
+Generates throw-away certificates in the layout of the real ones (client
+certificate issued by the MFCR playground CA, gateway signing certificate,
+TLS certificate for localhost) and answers every request with a signed
+Odpoved after a configurable latency. A part of the answers can be
+rejections with error code -1 (temporary technical error).
+
+    python benchmarks/gateway.py --port 8443 --latency 0.05 --error-rate 0.1
+'''
+
+import argparse
+import base64
+import hashlib
+import multiprocessing
+import os
+import random
+import socket
+import socketserver
+import ssl
+import sys
+import tempfile
+import time
+import uuid
+
+from datetime import datetime, timedelta
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+from cryptography import x509
+from cryptography.x509.oid import NameOID
+from cryptography.hazmat.backends import default_backend
+from cryptography.hazmat.primitives import hashes, serialization
+from cryptography.hazmat.primitives.asymmetric import padding, rsa
+from lxml import etree
+
+CA_ORGANIZATION = "Česká Republika – Generální finanční ředitelství"
+GATEWAY_ORGANIZATION = "Česká republika - Generální finanční ředitelství"
+
+_RESPONSE = (
+    '<soapenv:Envelope xmlns:soapenv="http://schemas.xmlsoap.org/soap/envelope/"><soapenv:Header>'
+    '<wsse:Security xmlns:wsse="http://docs.oasis-open.org/wss/2004/01/oasis-200401-wss-wssecurity-secext-1.0.xsd" '
+    'xmlns:wsu="http://docs.oasis-open.org/wss/2004/01/oasis-200401-wss-wssecurity-utility-1.0.xsd" soapenv:mustUnderstand="1">'
+    '<wsse:BinarySecurityToken EncodingType="http://docs.oasis-open.org/wss/2004/01/oasis-200401-wss-soap-message-security-1.0#Base64Binary" '
+    'ValueType="http://docs.oasis-open.org/wss/2004/01/oasis-200401-wss-x509-token-profile-1.0#X509v3" wsu:Id="X509-TOKEN">{token}</wsse:BinarySecurityToken>'
+    '<ds:Signature xmlns:ds="http://www.w3.org/2000/09/xmldsig#" Id="SIG"><ds:SignedInfo>'
+    '<ds:CanonicalizationMethod Algorithm="http://www.w3.org/2001/10/xml-exc-c14n#"/>'
+    '<ds:SignatureMethod Algorithm="http://www.w3.org/2001/04/xmldsig-more#rsa-sha256"/>'
+    '<ds:Reference URI="#id-BODY"><ds:Transforms><ds:Transform Algorithm="http://www.w3.org/2001/10/xml-exc-c14n#"/></ds:Transforms>'
+    '<ds:DigestMethod Algorithm="http://www.w3.org/2001/04/xmlenc#sha256"/><ds:DigestValue></ds:DigestValue></ds:Reference>'
+    '</ds:SignedInfo><ds:SignatureValue></ds:SignatureValue><ds:KeyInfo><wsse:SecurityTokenReference>'
+    '<wsse:Reference URI="#X509-TOKEN" ValueType="http://docs.oasis-open.org/wss/2004/01/oasis-200401-wss-x509-token-profile-1.0#X509v3"/>'
+    '</wsse:SecurityTokenReference></ds:KeyInfo></ds:Signature></wsse:Security></soapenv:Header>'
+    '<soapenv:Body xmlns:wsu="http://docs.oasis-open.org/wss/2004/01/oasis-200401-wss-wssecurity-utility-1.0.xsd" wsu:Id="id-BODY">'
+    '<eet:Odpoved xmlns:eet="http://fs.mfcr.cz/eet/schema/v3">'
+    '<eet:Hlavicka uuid_zpravy="{uuid}" bkp="{bkp}" {date}="2019-01-01T12:00:00+01:00"/>{content}'
+    '</eet:Odpoved></soapenv:Body></soapenv:Envelope>'
+)
+
+_DS = "{http://www.w3.org/2000/09/xmldsig#}"
+
+
+def _certificate(subject, issuer, key, signing_key, days=30, dns=None):
+    now = datetime.utcnow()
+    builder = (
+        x509.CertificateBuilder()
+        .subject_name(x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, subject[0]), x509.NameAttribute(NameOID.ORGANIZATION_NAME, subject[1])]))
+        .issuer_name(x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, issuer[0]), x509.NameAttribute(NameOID.ORGANIZATION_NAME, issuer[1])]))
+        .public_key(key.public_key())
+        .serial_number(x509.random_serial_number())
+        .not_valid_before(now - timedelta(days=1))
+        .not_valid_after(now + timedelta(days=days))
+    )
+    if dns is not None:
+        builder = builder.add_extension(x509.SubjectAlternativeName([x509.DNSName(dns)]), False)
+        builder = builder.add_extension(x509.BasicConstraints(ca=True, path_length=None), True)
+    return builder.sign(signing_key, hashes.SHA256(), default_backend())
+
+
+def _key():
+    return rsa.generate_private_key(65537, 2048, default_backend())
+
+
+def _pem(cert=None, key=None):
+    if cert is not None:
+        return cert.public_bytes(serialization.Encoding.PEM)
+    return key.private_bytes(serialization.Encoding.PEM, serialization.PrivateFormat.PKCS8, serialization.NoEncryption())
+
+
+class Certificates:
+    '''
+    Throw-away certificates, PEM encoded
+    '''
+
+    def __init__(self, dic="CZ00000019"):
+        ca_key = _key()
+        ca = ("EET CA 1 Playground", CA_ORGANIZATION)
+
+        client_key = _key()
+        self.client_cert = _pem(_certificate((dic, "benchmark"), ca, client_key, ca_key))
+        self.client_key = _pem(key=client_key)
+
+        gateway_key = _key()
+        self.gateway_cert = _pem(_certificate(("eet", GATEWAY_ORGANIZATION), ca, gateway_key, ca_key))
+        self.gateway_key = _pem(key=gateway_key)
+
+        tls_key = _key()
+        self.tls_cert = _pem(_certificate(("localhost", "benchmark"), ("localhost", "benchmark"), tls_key, tls_key, dns="localhost"))
+        self.tls_key = _pem(key=tls_key)
+
+    def client_context(self):
+        '''
+        ssl.SSLContext trusting the gateway TLS certificate
+        '''
+        return ssl.create_default_context(cadata=self.tls_cert.decode())
+
+
+def signed_response(certificates, error=None, warning=False):
+    '''
+    Signed Odpoved accepting the invoice, or rejecting it with error code
+    '''
+    if error is None:
+        content = '<eet:Potvrzeni fik="{0}-ff" test="true"/>'.format(uuid.uuid4())
+        date = "dat_prij"
+    else:
+        content = '<eet:Chyba kod="{0}" test="true">Docasna technicka chyba zpracovani</eet:Chyba>'.format(error)
+        date = "dat_odmit"
+    if warning:
+        content += '<eet:Varovani kod_varov="1">DIC poplatnika v datove zprave se neshoduje s DIC v certifikatu</eet:Varovani>'
+
+    token = "".join(certificates.gateway_cert.decode().strip().splitlines()[1:-1])
+    root = etree.fromstring(_RESPONSE.format(
+        token=token,
+        uuid=uuid.uuid4(),
+        bkp="00000000-00000000-00000000-00000000-00000000",
+        date=date,
+        content=content
+    ))
+
+    body = root.find("{http://schemas.xmlsoap.org/soap/envelope/}Body")
+    digest = hashlib.sha256(etree.tostring(body, method="c14n", exclusive=True)).digest()
+    root.find(".//" + _DS + "DigestValue").text = base64.b64encode(digest).decode()
+
+    key = serialization.load_pem_private_key(certificates.gateway_key, None, default_backend())
+    signed_info = etree.tostring(root.find(".//" + _DS + "SignedInfo"), method="c14n", exclusive=True)
+    signature = key.sign(signed_info, padding.PKCS1v15(), hashes.SHA256())
+    root.find(".//" + _DS + "SignatureValue").text = base64.b64encode(signature).decode()
+    return etree.tostring(root)
+
+
+class _Server(socketserver.ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+    request_queue_size = 128
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def setup(self):
+        super().setup()
+        # headers and body go out in separate writes, do not let Nagle delay the body
+        self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    def log_message(self, *args):
+        pass
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        if self.server.latency:
+            time.sleep(self.server.latency)
+        if random.random() < self.server.error_rate:
+            body = self.server.rejected
+        else:
+            body = self.server.accepted
+        self.send_response(200)
+        self.send_header("Content-Type", "text/xml; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+def serve(certificates, port=0, latency=0.0, error_rate=0.0, ready=None):
+    '''
+    Run the gateway until interrupted, ready.send(port) once listening
+    '''
+    # responses are signed up front so the gateway costs the client as little CPU as possible
+    server = _Server(("127.0.0.1", port), _Handler)
+    server.latency = latency
+    server.error_rate = error_rate
+    server.accepted = signed_response(certificates)
+    server.rejected = signed_response(certificates, error=-1)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        cert_file = os.path.join(tmp, "tls.pem")
+        key_file = os.path.join(tmp, "tls.key")
+        with open(cert_file, "wb") as f:
+            f.write(certificates.tls_cert)
+        with open(key_file, "wb") as f:
+            f.write(certificates.tls_key)
+        context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+        context.load_cert_chain(cert_file, key_file)
+    server.socket = context.wrap_socket(server.socket, server_side=True)
+
+    if ready is not None:
+        ready.send(server.server_address[1])
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+
+
+class Gateway:
+    '''
+    Gateway running in a separate process, so it does not compete with the
+    measured code for the GIL
+
+        with Gateway(certificates, latency=0.02) as url:
+            ...
+    '''
+
+    def __init__(self, certificates, latency=0.0, error_rate=0.0):
+        self._args = (certificates, 0, latency, error_rate)
+        self._process = None
+
+    def __enter__(self):
+        receiver, sender = multiprocessing.Pipe(False)
+        self._process = multiprocessing.Process(target=serve, args=self._args + (sender,), daemon=True)
+        self._process.start()
+        if not receiver.poll(30):
+            self._process.terminate()
+            raise RuntimeError("gateway did not start")
+        return "https://localhost:{0}/eet/services/EETServiceSOAP/v3/".format(receiver.recv())
+
+    def __exit__(self, *exc):
+        self._process.terminate()
+        self._process.join()
+        return False
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--port", type=int, default=8443)
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds before answering")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="share of rejected invoices")
+    parser.add_argument("--out", default=".", help="directory to write client.pem, client.key and tls.pem to")
+    args = parser.parse_args(argv)
+
+    certificates = Certificates()
+    for name, content in (("client.pem", certificates.client_cert), ("client.key", certificates.client_key), ("tls.pem", certificates.tls_cert)):
+        with open(os.path.join(args.out, name), "wb") as f:
+            f.write(content)
+    print("listening on https://localhost:{0}/".format(args.port), file=sys.stderr)
+    try:
+        serve(certificates, args.port, args.latency, args.error_rate)
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,73 @@
+'''
+Import time of eet modules against a budget
+
+Every module is imported in a fresh interpreter (python -X importtime),
+the best of --repeat runs is compared with its budget in milliseconds.
+Modules that must stay unloaded after the import are checked too, which
+does not depend on the speed of the machine. Exits with 1 on failure.
+
+    python benchmarks/importtime.py
+    python benchmarks/importtime.py --scale 2   # slower machine, double budgets
+'''
+
+import argparse
+import os
+import subprocess
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# module: (budget in ms, modules it must not load)
+BUDGETS = {
+    "eet.types": (40, ("lxml", "cryptography", "ssl", "asyncio", "sqlite3", "http.client")),
+    "eet.invoices": (60, ("lxml", "cryptography", "ssl", "asyncio", "sqlite3", "http.client", "urllib.request", "multiprocessing")),
+    "eet.remote": (250, ()),
+    "eet.daemon": (60, ("lxml", "cryptography", "ssl", "sqlite3", "http.client")),
+}
+
+
+def measure(module):
+    '''
+    Cumulative import time of module in microseconds and modules it loaded
+    '''
+    code = "import sys, {0}; print(' '.join(sys.modules))".format(module)
+    env = dict(os.environ, PYTHONPATH=ROOT + os.pathsep + os.environ.get("PYTHONPATH", ""))
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", code],
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        universal_newlines=True,
+        env=env,
+        check=True
+    )
+    total = 0
+    for line in result.stderr.splitlines():
+        # import time: self [us] | cumulative | imported package
+        parts = line.split("|")
+        if len(parts) == 3 and parts[2].strip() == module and not parts[2][1:].startswith(" "):
+            total = int(parts[1])
+    return total, set(result.stdout.split())
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--scale", type=float, default=1, help="multiply all budgets")
+    args = parser.parse_args(argv)
+
+    failed = False
+    for module, (budget, forbidden) in BUDGETS.items():
+        runs = [measure(module) for _ in range(args.repeat)]
+        best = min(total for total, _ in runs) / 1000
+        loaded = sorted(name for name in forbidden if name in runs[0][1])
+        ok = best <= budget * args.scale and not loaded
+        failed = failed or not ok
+        print("{0:<16}{1:>8.1f} ms  budget {2:>6.1f} ms  {3}{4}".format(
+            module, best, budget * args.scale, "ok" if ok else "FAILED",
+            "" if not loaded else ", loaded " + ", ".join(loaded)
+        ))
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
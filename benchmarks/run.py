@@ -0,0 +1,171 @@
+'''
+Throughput, latency percentiles and memory of the main code paths
+
+Runs against the local gateway from gateway.py, never against eet.cz.
+
+    python benchmarks/run.py --count 2000 --latency 0.01 --json result.json
+    python benchmarks/run.py --baseline result.json
+
+Save the result of a run before a change and pass it as --baseline after
+it; every stage is then printed with its speedup against the baseline.
+'''
+
+import argparse
+import gc
+import json
+import os
+import platform
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from eet import binding, helpers, invoices, remote, storage, transport
+
+import gateway
+
+
+def _percentile(durations, p):
+    return durations[min(len(durations) - 1, int(len(durations) * p / 100))]
+
+
+def _stats(durations, elapsed):
+    durations = sorted(durations)
+    return {
+        "ops": len(durations) / elapsed,
+        "p50": _percentile(durations, 50),
+        "p95": _percentile(durations, 95),
+        "p99": _percentile(durations, 99),
+        "max": durations[-1]
+    }
+
+
+def _measure(fn, args):
+    '''
+    Call fn for each of args, timing every call
+    '''
+    durations = []
+    gc.collect()
+    start = time.perf_counter()
+    for arg in args:
+        t = time.perf_counter()
+        fn(arg)
+        durations.append(time.perf_counter() - t)
+    return _stats(durations, time.perf_counter() - start)
+
+
+def _sales(factory, count, prefix):
+    return [
+        factory.new("{0}-{1}".format(prefix, i), 100 + i % 1000, zakl_dan1=82.64, dan1=17.36)
+        for i in range(count)
+    ]
+
+
+def run(count, latency, error_rate, concurrency):
+    certificates = gateway.Certificates()
+    config = invoices.Config(helpers.parse_cert(certificates.client_cert), helpers.parse_key(certificates.client_key), 141, "1patro")
+    factory = invoices.Factory(config)
+    results = {}
+
+    def new(i):
+        factory.new("new-{0}".format(i), 100 + i % 1000, zakl_dan1=82.64, dan1=17.36)
+    results["Factory.new"] = _measure(new, range(count))
+
+    results["Invoice.build"] = _measure(lambda invoice: invoice.build(), _sales(factory, count, "build"))
+
+    response = gateway.signed_response(certificates)
+    results["Soap.parse_response"] = _measure(lambda i: binding.Soap.parse_response(response, True), range(count))
+
+    # memory held by signed invoices waiting in the queue
+    gc.collect()
+    tracemalloc.start()
+    queue = storage.MemoryQueue()
+    for invoice in _sales(factory, count, "queued"):
+        invoice.build()
+        queue.put(invoice)
+    held, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    results["memory"] = {"queued_bytes_per_invoice": held / count, "peak_bytes": peak}
+    del queue
+
+    endpoint = remote.Scheduler.PLAYGROUND_ENDPOINT
+    with gateway.Gateway(certificates, latency, error_rate) as url:
+        remote.Scheduler.PLAYGROUND_ENDPOINT = url
+        try:
+            client = transport.Transport(pool_size=concurrency, context=certificates.client_context())
+
+            # warm up connections and the certificate cache
+            for invoice in _sales(factory, concurrency, "warmup"):
+                remote.Scheduler.send(invoice, client)
+
+            results["Scheduler.send"] = _measure(lambda invoice: remote.Scheduler.send(invoice, client), _sales(factory, count, "send"))
+
+            # every invoice is in the queue and due, a single pass sends them all
+            scheduler = remote.Scheduler(client, concurrency=concurrency)
+            for invoice in _sales(factory, count, "dispatch"):
+                invoice.build()
+                scheduler._queue.put(invoice)
+            gc.collect()
+            start = time.perf_counter()
+            scheduler.dispatch()
+            elapsed = time.perf_counter() - start
+            results["Scheduler.dispatch"] = {"ops": count / elapsed, "left": len(scheduler._queue)}
+            client.close()
+        finally:
+            remote.Scheduler.PLAYGROUND_ENDPOINT = endpoint
+
+    return {
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "count": count,
+        "latency": latency,
+        "error_rate": error_rate,
+        "concurrency": concurrency,
+        "results": results
+    }
+
+
+def report(run, baseline=None):
+    lines = ["{0:<22}{1:>12}{2:>10}{3:>10}{4:>10}{5:>10}".format("stage", "ops/s", "p50 ms", "p95 ms", "p99 ms", "vs base")]
+    for stage, stats in run["results"].items():
+        if stage == "memory":
+            continue
+        row = "{0:<22}{1:>12.1f}".format(stage, stats["ops"])
+        if "p50" in stats:
+            row += "{0:>10.3f}{1:>10.3f}{2:>10.3f}".format(stats["p50"] * 1000, stats["p95"] * 1000, stats["p99"] * 1000)
+        else:
+            row += " " * 30
+        if baseline is not None and stage in baseline["results"]:
+            row += "{0:>9.2f}x".format(stats["ops"] / baseline["results"][stage]["ops"])
+        lines.append(row)
+    memory = run["results"]["memory"]
+    lines.append("memory: {0:.0f} bytes per queued invoice, peak {1:.1f} MiB".format(
+        memory["queued_bytes_per_invoice"], memory["peak_bytes"] / 2 ** 20
+    ))
+    return "\n".join(lines)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--count", type=int, default=1000, help="invoices per stage")
+    parser.add_argument("--latency", type=float, default=0.0, help="gateway latency in seconds")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="share of invoices rejected by the gateway")
+    parser.add_argument("--concurrency", type=int, default=4, help="connections used by dispatch")
+    parser.add_argument("--json", help="write results to this file")
+    parser.add_argument("--baseline", help="compare with results written by --json")
+    args = parser.parse_args(argv)
+
+    result = run(args.count, args.latency, args.error_rate, args.concurrency)
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+    print(report(result, baseline))
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(result, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,9 @@
+import importlib
+
+_SUBMODULES = ("binding", "cli", "daemon", "helpers", "invoices", "monitoring", "records", "registry", "remote", "storage", "transport", "types")
+
+def __getattr__(name):
+    # import eet; eet.invoices.Config(...) works without importing everything up front
+    if name in _SUBMODULES:
+        return importlib.import_module("." + name, __name__)
+    raise AttributeError("module {0!r} has no attribute {1!r}".format(__name__, name))
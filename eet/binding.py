@@ -1,13 +1,18 @@
 from . import types, helpers
+from .records import Record, Trzba, Odpoved
 
+from datetime import datetime
 from pathlib import Path
 from lxml import etree
 
 import re
+import collections
+import copy
 import base64
 import hashlib
 import uuid
 import textwrap
+import threading
 
 # Let's stay cryptic
 from cryptography.x509 import Certificate, oid
@@ -15,75 +20,104 @@ from cryptography.hazmat.primitives import serialization, hashes
 from cryptography.hazmat.primitives.asymmetric.rsa import RSAPrivateKey
 from cryptography.hazmat.primitives.asymmetric import padding
 
-class Trzba:
-    Hlavicka = {
-        "uuid_zpravy": None, # types.UUIDType,
-        "dat_odesl": None, # types.dateTime,
-        "prvni_zaslani": None, # types.boolean,
-        "overeni": None # Optional[types.boolean]
-    }
-    Data = {
-        "dic_popl": None, # types.CZDICType,
-        "dic_poverujiciho": None, # Optional[types.CZDICType],
-        "id_provoz": None, # types.IdProvozType,
-        "id_pokl": None, # types.string20,
-        "porad_cis": None, # types.string25,
-        "dat_trzby": None, # types.dateTime,
-        "celk_trzba": None, # types.CastkaType,
-        "zakl_nepodl_dph": None, # Optional[types.CastkaType],
-        "zakl_dan1": None, # Optional[types.CastkaType],
-        "dan1": None, # Optional[types.CastkaType],
-        "zakl_dan2": None, # Optional[types.CastkaType],
-        "dan2": None, # Optional[types.CastkaType],
-        "zakl_dan3": None, # Optional[types.CastkaType],
-        "dan3": None, # Optional[types.CastkaType],
-        "cest_sluz": None, # Optional[types.CastkaType],
-        "pouzit_zboz1": None, # Optional[types.CastkaType],
-        "pouzit_zboz2": None, # Optional[types.CastkaType],
-        "pouzit_zboz3": None, # Optional[types.CastkaType],
-        "urceno_cerp_zuct": None, # Optional[types.CastkaType],
-        "cerp_zuct": None, # Optional[types.CastkaType],
-        "rezim": None # types.RezimType
-    }
-    KontrolniKody = {
-        "pkp": {
-            "digest": "SHA256", # str
-            "cipher": "RSA2048", # str
-            "encoding": "base64" # str
-        },
-        "bkp": {
-            "digest": "SHA1", # str
-            "encoding": "base16" # str
-        }
-    }
-    Codes = {
-        "pkp": None, # types.PkpType
-        "bkp": None # types.BkpType
-    }
-
-class Odpoved:
-    Hlavicka = {
-        "uuid_zpravy": None, # Optional[types.UUIDType]
-        "bkp": None, # Optional[types.BkpType]
-        "dat_prij": None, # Optional[types.dateTime]
-        "dat_odmit": None # Optional[types.dateTime]
-    }
-    Potvrzeni = {
-        "fik": None, # types.FikType
-        "test": None # Optional[types.boolean]
-    }
-    Chyba = {
-        "kod": None, # types.KodChybaType
-        "test": None, # Optional[types.boolean],
-        "text": None # str
-    }
-    Varovani = {
-        "kod_varov": None, # Optional[types.KodVarovType]
-        "text": None # str
-    }
+_WSU_ID = "{http://docs.oasis-open.org/wss/2004/01/oasis-200401-wss-wssecurity-utility-1.0.xsd}Id"
+
+# nodes of the response looked up by parse_response
+_SECURITY = "{http://docs.oasis-open.org/wss/2004/01/oasis-200401-wss-wssecurity-secext-1.0.xsd}Security"
+_TOKEN = "{http://docs.oasis-open.org/wss/2004/01/oasis-200401-wss-wssecurity-secext-1.0.xsd}BinarySecurityToken"
+_WSSE_REFERENCE = "{http://docs.oasis-open.org/wss/2004/01/oasis-200401-wss-wssecurity-secext-1.0.xsd}Reference"
+_SIGNED_INFO = "{http://www.w3.org/2000/09/xmldsig#}SignedInfo"
+_SIGNATURE_VALUE = "{http://www.w3.org/2000/09/xmldsig#}SignatureValue"
+_DS_REFERENCE = "{http://www.w3.org/2000/09/xmldsig#}Reference"
+_DIGEST_VALUE = "{http://www.w3.org/2000/09/xmldsig#}DigestValue"
+_BODY = "{http://schemas.xmlsoap.org/soap/envelope/}Body"
+_HLAVICKA = "{http://fs.mfcr.cz/eet/schema/v3}Hlavicka"
+_POTVRZENI = "{http://fs.mfcr.cz/eet/schema/v3}Potvrzeni"
+_CHYBA = "{http://fs.mfcr.cz/eet/schema/v3}Chyba"
+_VAROVANI = "{http://fs.mfcr.cz/eet/schema/v3}Varovani"
+_RESPONSE_NODES = (
+    _SECURITY, _TOKEN, _WSSE_REFERENCE, _SIGNED_INFO, _SIGNATURE_VALUE, _DS_REFERENCE,
+    _DIGEST_VALUE, _BODY, _HLAVICKA, _POTVRZENI, _CHYBA, _VAROVANI
+)
+
+# escaping of etree.tostring and of canonical XML (c14n)
+_XML_TEXT = str.maketrans({"&": "&amp;", "<": "&lt;", ">": "&gt;", "\r": "&#13;"})
+_XML_ATTR = str.maketrans({"&": "&amp;", "<": "&lt;", ">": "&gt;", "\"": "&quot;", "\t": "&#9;", "\n": "&#10;", "\r": "&#13;"})
+_C14N_TEXT = str.maketrans({"&": "&amp;", "<": "&lt;", ">": "&gt;", "\r": "&#xD;"})
+_C14N_ATTR = str.maketrans({"&": "&amp;", "<": "&lt;", "\"": "&quot;", "\t": "&#x9;", "\n": "&#xA;", "\r": "&#xD;"})
+
+_SPECIAL = re.compile(r'[&<>"\t\n\r]')
+
+def _escape(text, table):
+    # validated values rarely need escaping, translate is the slow part
+    return text.translate(table) if _SPECIAL.search(text) else text
+
+def _xml_attrs(attrs):
+    return "".join(' {0}="{1}"'.format(k, _escape(v, _XML_ATTR)) for k, v in attrs)
+
+def _c14n_attrs(attrs):
+    # c14n orders attributes without namespace by name
+    return "".join(' {0}="{1}"'.format(k, _escape(v, _C14N_ATTR)) for k, v in sorted(attrs))
+
+def _format_string(text):
+    return re.sub(r"@(\w+)@", r"{\1}", text.replace("{", "{{").replace("}", "}}"))
+
+_local = threading.local()
+
+def _parser():
+    # lxml parsers must not be used by two threads at once, keep one per thread
+    if not hasattr(_local, "parser"):
+        _local.parser = etree.XMLParser(remove_blank_text=True)
+    return _local.parser
+
+class _CertificateCache:
+    '''
+    Verified server certificates by their BinarySecurityToken text
+
+    Keeps public keys of at most size certificates that passed the
+    issuer and validity checks, each until the certificate expires.
+    '''
+
+    def __init__(self, size: int = 16):
+        self.size = size
+        self._keys = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, token: str):
+        with self._lock:
+            entry = self._keys.get(token)
+            if entry is not None:
+                if entry[1] > datetime.utcnow():
+                    self._keys.move_to_end(token)
+                    return entry[0]
+                del self._keys[token]
+
+        server_cert = helpers.parse_cert(b"-----BEGIN CERTIFICATE-----\n" + textwrap.fill(token, 64).encode() + b"\n-----END CERTIFICATE-----\n")
+
+        if server_cert.subject.get_attributes_for_oid(oid.NameOID.ORGANIZATION_NAME)[0].value != "Česká republika - Generální finanční ředitelství":
+            raise ValueError("invalid server certificate")
+
+        if not helpers._check_validity(server_cert):
+            raise ValueError("server certificate expired")
+
+        public_key = server_cert.public_key()
+        with self._lock:
+            self._keys[token] = (public_key, server_cert.not_valid_after)
+            while len(self._keys) > self.size:
+                self._keys.popitem(last=False)
+        return public_key
+
+    def clear(self):
+        with self._lock:
+            self._keys.clear()
+
+_server_certs = _CertificateCache()
 
 class Soap:
 
+    # parsed envelope template, shared by all instances (see _template)
+    _TEMPLATE = None
+
     def __init__(self, cert: Certificate, private_key: RSAPrivateKey):
         if not isinstance(cert, Certificate):
             raise ValueError("cert is not instance of Certificate")
@@ -92,12 +126,95 @@ class Soap:
         if not isinstance(private_key, RSAPrivateKey):
             raise ValueError("private_key is not instance of RSAPrivateKey")
         self.private_key = private_key
+
+        # fixed parts of every envelope, computed once per signer
+        self._token = self.__get_cert()
+        self._padding = padding.PKCS1v15()
+        self._hash = hashes.SHA256()
+        self._fragments = None
     
     def __get_cert(self):
         return self.cert.public_bytes(serialization.Encoding.PEM).replace(b"-----BEGIN CERTIFICATE-----", b"").replace(b"-----END CERTIFICATE-----", b"").replace(b"\n", b"")
 
+    def sign(self, data: bytes):
+        return self.private_key.sign(data, self._padding, self._hash)
+
+    @classmethod
+    def _template(cls):
+        if cls._TEMPLATE is None:
+            parser = etree.XMLParser(remove_blank_text=True)
+            cls._TEMPLATE = etree.parse(str(Path(__file__).parent.absolute().joinpath('soap_template.xml')), parser).getroot()
+        return cls._TEMPLATE
+
     def build(self, sale: Trzba):
-        return etree.tostring(self._build_envelope(self._build_data_element(sale)))
+        if sale.Codes["pkp"] is None or sale.Codes["bkp"] is None:
+            return etree.tostring(self._build_envelope(self._build_data_element(sale)))
+
+        binary_token = "X509-" + str(uuid.uuid4())
+        uuid_token = "id-" + str(uuid.uuid4())
+        envelope, body, signed_info = self._templates()
+
+        hlavicka = [(k, str(v)) for k, v in sale.Hlavicka.items() if v is not None]
+        data = [(k, str(v)) for k, v in sale.Data.items() if v is not None]
+
+        # same bytes as exclusive c14n of the Body and SignedInfo built by lxml
+        body_text = body.format(
+            body_id=uuid_token,
+            hlavicka=_c14n_attrs(hlavicka),
+            data=_c14n_attrs(data),
+            pkp=_escape(str(sale.Codes["pkp"]), _C14N_TEXT),
+            bkp=_escape(str(sale.Codes["bkp"]), _C14N_TEXT)
+        ).encode("utf8")
+        digest = base64.b64encode(hashlib.sha256(body_text).digest()).decode()
+        signed_text = signed_info.format(body_id=uuid_token, digest=digest).encode("utf8")
+        signature = base64.b64encode(self.sign(signed_text)).decode()
+
+        # same bytes as etree.tostring of the envelope
+        return envelope.format(
+            token_id=binary_token,
+            body_id=uuid_token,
+            digest=digest,
+            signature=signature,
+            hlavicka=_xml_attrs(hlavicka),
+            data=_xml_attrs(data),
+            pkp=_escape(str(sale.Codes["pkp"]), _XML_TEXT),
+            bkp=_escape(str(sale.Codes["bkp"]), _XML_TEXT)
+        ).encode("ascii", "xmlcharrefreplace")
+
+    def _templates(self):
+        '''
+        Envelope, canonical Body and canonical SignedInfo as format strings
+
+        Serialized once by lxml from an envelope with @name@ markers in
+        place of the per-message values.
+        '''
+        if self._fragments is None:
+            sale = Trzba()
+            sale.Codes["pkp"] = "@pkp@"
+            sale.Codes["bkp"] = "@bkp@"
+
+            root = copy.deepcopy(Soap._template())
+            body = root.find(".//" + _BODY)
+            body.set(_WSU_ID, "@body_id@")
+            body.append(self._build_data_element(sale))
+            token = root.find(".//" + _TOKEN)
+            token.set(_WSU_ID, "@token_id@")
+            token.text = self._token
+            root.find(".//" + _DS_REFERENCE).set("URI", "#@body_id@")
+            root.find(".//" + _DIGEST_VALUE).text = "@digest@"
+            root.find(".//" + _SIGNATURE_VALUE).text = "@signature@"
+            root.find(".//" + _WSSE_REFERENCE).set("URI", "#@token_id@")
+
+            envelope = etree.tostring(root).decode("ascii")
+            body_text = etree.tostring(body, method='c14n', exclusive=True, with_comments=False).decode("utf8")
+            signed_text = etree.tostring(root.find(".//" + _SIGNED_INFO), method='c14n', exclusive=True, with_comments=False).decode("utf8")
+
+            # empty Hlavicka and Data get their attributes at build time
+            envelope = envelope.replace("<Hlavicka/>", "<Hlavicka@hlavicka@/>").replace("<Data/>", "<Data@data@/>")
+            body_text = body_text.replace("<Hlavicka></Hlavicka>", "<Hlavicka@hlavicka@></Hlavicka>").replace("<Data></Data>", "<Data@data@></Data>")
+
+            self._fragments = tuple(_format_string(text) for text in (envelope, body_text, signed_text))
+        return self._fragments
 
     def _build_data_element(self, sale: Trzba):
         root = etree.Element("{http://fs.mfcr.cz/eet/schema/v3}Trzba", nsmap={
@@ -106,8 +223,8 @@ class Soap:
             "xsd": "http://www.w3.org/2001/XMLSchema"
         })
 
-        etree.SubElement(root, "{http://fs.mfcr.cz/eet/schema/v3}Hlavicka", {k: str(v) for k, v in Trzba.Hlavicka.items() if v is not None})
-        etree.SubElement(root, "{http://fs.mfcr.cz/eet/schema/v3}Data", {k: str(v) for k, v in Trzba.Data.items() if v is not None})
+        etree.SubElement(root, "{http://fs.mfcr.cz/eet/schema/v3}Hlavicka", {k: str(v) for k, v in sale.Hlavicka.items() if v is not None})
+        etree.SubElement(root, "{http://fs.mfcr.cz/eet/schema/v3}Data", {k: str(v) for k, v in sale.Data.items() if v is not None})
         codes = etree.SubElement(root, "{http://fs.mfcr.cz/eet/schema/v3}KontrolniKody")
 
         etree.SubElement(codes, "{http://fs.mfcr.cz/eet/schema/v3}pkp", sale.KontrolniKody["pkp"]).text = sale.Codes["pkp"]
@@ -120,10 +237,9 @@ class Soap:
         binary_token = "X509-" + str(uuid.uuid4())
         uuid_token = "id-" + str(uuid.uuid4())
 
-        parser = etree.XMLParser(remove_blank_text=True)
-        tree = etree.parse(str(Path(__file__).parent.absolute().joinpath('soap_template.xml')), parser)
-        root = tree.getroot()
-        
+        # never modify the template itself, work on a copy
+        root = copy.deepcopy(Soap._template())
+
         # add body
         body = root.find(".//{http://schemas.xmlsoap.org/soap/envelope/}Body")
         body.set("{http://docs.oasis-open.org/wss/2004/01/oasis-200401-wss-wssecurity-utility-1.0.xsd}Id", uuid_token)
@@ -132,7 +248,7 @@ class Soap:
         # add cert
         BinarySecurityToken = root.find(".//{http://docs.oasis-open.org/wss/2004/01/oasis-200401-wss-wssecurity-secext-1.0.xsd}BinarySecurityToken")
         BinarySecurityToken.set("{http://docs.oasis-open.org/wss/2004/01/oasis-200401-wss-wssecurity-utility-1.0.xsd}Id", binary_token)
-        BinarySecurityToken.text = self.__get_cert()
+        BinarySecurityToken.text = self._token
 
         # cert ref
         root.find(".//{http://www.w3.org/2000/09/xmldsig#}Reference").set("URI", "#" + uuid_token)
@@ -145,7 +261,7 @@ class Soap:
         # header signed
         signed_info = root.find(".//{http://www.w3.org/2000/09/xmldsig#}SignedInfo")
         signed_text = etree.tostring(signed_info, method='c14n', exclusive=True, with_comments=False)
-        signed_signed = self.private_key.sign(signed_text, padding.PKCS1v15(), hashes.SHA256())
+        signed_signed = self.sign(signed_text)
         root.find(".//{http://www.w3.org/2000/09/xmldsig#}SignatureValue").text = base64.b64encode(signed_signed)
 
         root.find(".//{http://docs.oasis-open.org/wss/2004/01/oasis-200401-wss-wssecurity-secext-1.0.xsd}Reference").set("URI", "#" + binary_token)
@@ -153,42 +269,33 @@ class Soap:
         return root
 
     @staticmethod
-    def __validate_message(root: etree, ignore_invalid_cert):
-
-        server_cert_text = root.find(".//{http://docs.oasis-open.org/wss/2004/01/oasis-200401-wss-wssecurity-secext-1.0.xsd}BinarySecurityToken").text
-        server_cert = helpers.parse_cert(b"-----BEGIN CERTIFICATE-----\n" + textwrap.fill(server_cert_text, 64).encode() + b"\n-----END CERTIFICATE-----\n")
+    def __validate_message(nodes, ignore_invalid_cert):
 
-        if server_cert.subject.get_attributes_for_oid(oid.NameOID.ORGANIZATION_NAME)[0].value != "Česká republika - Generální finanční ředitelství":
-            raise ValueError("invalid server certificate")
-            
-        if not helpers._check_validity(server_cert):
-            raise ValueError("server certificate expired")
+        public_key = _server_certs.get(nodes[_TOKEN].text)
 
         if not ignore_invalid_cert:
             # validate signature
-            signature = root.find(".//{http://www.w3.org/2000/09/xmldsig#}SignatureValue").text
-            signed_info = root.find(".//{http://www.w3.org/2000/09/xmldsig#}SignedInfo")
-            signed_text = etree.tostring(signed_info, method='c14n', exclusive=True, with_comments=False)
-            server_cert.public_key().verify(base64.b64decode(signature), signed_text, padding.PKCS1v15(), hashes.SHA256())
+            signature = nodes[_SIGNATURE_VALUE].text
+            signed_text = etree.tostring(nodes[_SIGNED_INFO], method='c14n', exclusive=True, with_comments=False)
+            public_key.verify(base64.b64decode(signature), signed_text, padding.PKCS1v15(), hashes.SHA256())
         
         # validate digest
-        body = root.find(".//{http://schemas.xmlsoap.org/soap/envelope/}Body")
+        body = nodes[_BODY]
         body_text = etree.tostring(body, method='c14n', exclusive=True, with_comments=False)
         digest = base64.b64encode(hashlib.sha256(body_text).digest()).decode()
-        if not root.find(".//{http://www.w3.org/2000/09/xmldsig#}DigestValue").text == digest:
+        if not nodes[_DIGEST_VALUE].text == digest:
             raise ValueError("invalid digest")
 
         # validate ref
-        body_id = body.get("{http://docs.oasis-open.org/wss/2004/01/oasis-200401-wss-wssecurity-utility-1.0.xsd}Id")
-        ref_id = root.find(".//{http://www.w3.org/2000/09/xmldsig#}Reference").get("URI")
+        body_id = body.get(_WSU_ID)
+        ref_id = nodes[_DS_REFERENCE].get("URI")
 
         if ref_id != "#" + body_id:
             raise ValueError("invalid body ref")
 
         # validate token
-        BinarySecurityToken = root.find(".//{http://docs.oasis-open.org/wss/2004/01/oasis-200401-wss-wssecurity-secext-1.0.xsd}BinarySecurityToken")
-        sec_token = BinarySecurityToken.get("{http://docs.oasis-open.org/wss/2004/01/oasis-200401-wss-wssecurity-utility-1.0.xsd}Id")
-        ref_token = root.find(".//{http://docs.oasis-open.org/wss/2004/01/oasis-200401-wss-wssecurity-secext-1.0.xsd}Reference").get("URI")
+        sec_token = nodes[_TOKEN].get(_WSU_ID)
+        ref_token = nodes[_WSSE_REFERENCE].get("URI")
 
         if ref_token != "#" + sec_token:
             raise ValueError("invalid security token")
@@ -204,31 +311,35 @@ class Soap:
     
     @staticmethod
     def parse_response(text: str, ignore_invalid_cert=False):
-        parser = etree.XMLParser(remove_blank_text=True)
-        root = etree.XML(text, parser)
+        root = etree.XML(text, _parser())
+
+        # one walk over the document, keeping the first match of every node
+        nodes = {}
+        for node in root.iter(*_RESPONSE_NODES):
+            nodes.setdefault(node.tag, node)
 
-        if root.find(".//{http://docs.oasis-open.org/wss/2004/01/oasis-200401-wss-wssecurity-secext-1.0.xsd}Security") is not None:
-            Soap.__validate_message(root, ignore_invalid_cert)
+        if _SECURITY in nodes:
+            Soap.__validate_message(nodes, ignore_invalid_cert)
         
         resp = Odpoved()
-        header = root.find(".//{http://fs.mfcr.cz/eet/schema/v3}Hlavicka")
+        header = nodes.get(_HLAVICKA)
         resp.Hlavicka["uuid_zpravy"] = Soap._convert(header.get("uuid_zpravy"), types.UUIDType)
         resp.Hlavicka["bkp"] = Soap._convert(header.get("bkp"), types.BkpType)
         resp.Hlavicka["dat_prij"] = Soap._convert(header.get("dat_prij"), types.dateTime)
         resp.Hlavicka["dat_odmit"] = Soap._convert(header.get("dat_odmit"), types.dateTime)
         
-        success = root.find(".//{http://fs.mfcr.cz/eet/schema/v3}Potvrzeni")
+        success = nodes.get(_POTVRZENI)
         if success is not None:
             resp.Potvrzeni["fik"] = Soap._convert(success.get("fik"), types.FikType)
             resp.Potvrzeni["test"] = Soap._convert(success.get("test"), types.boolean)
         
-        error = root.find(".//{http://fs.mfcr.cz/eet/schema/v3}Chyba")
+        error = nodes.get(_CHYBA)
         if error is not None:
             resp.Chyba["kod"] = Soap._convert(error.get("kod"), types.KodChybaType)
             resp.Chyba["test"] = Soap._convert(error.get("test"), types.boolean)
             resp.Chyba["text"] = error.text
         
-        warning = root.find(".//{http://fs.mfcr.cz/eet/schema/v3}Varovani")
+        warning = nodes.get(_VAROVANI)
         if warning is not None:
             resp.Varovani["kod_varov"] = Soap._convert(warning.get("kod_varov"), types.KodVarovType)
             resp.Varovani["text"] = warning.text
@@ -0,0 +1,328 @@
+from . import invoices, helpers, remote, transport
+
+from concurrent.futures import ThreadPoolExecutor
+from decimal import Decimal
+
+import argparse
+import collections
+import csv
+import itertools
+import json
+import os
+import sys
+import time
+
+'''
+Command line interface, run as python -m eet
+'''
+
+def _rows(stream, fmt):
+    '''
+    (line number, dict or JSON text) for every receipt in stream, read lazily
+
+    JSON is parsed by _parse in the workers, so a bad line only makes its
+    receipt invalid.
+    '''
+    if fmt == "csv":
+        reader = csv.DictReader(stream)
+        for row in reader:
+            yield reader.line_num, row
+    else:
+        for number, line in enumerate(stream, 1):
+            if line.strip():
+                yield number, line
+
+def _parse(row):
+    if not isinstance(row, str):
+        return row
+    try:
+        return json.loads(row, parse_float=Decimal)
+    except ValueError as e:
+        raise ValueError("invalid JSON: " + str(e))
+
+def _status(resp):
+    if resp is None:
+        return "signed"
+    if resp:
+        return "accepted"
+    if resp.rejected():
+        return "rejected"
+    return "pending"
+
+def _result(number, row, invoice=None, resp=None, error=None, status=None):
+    codes = invoice.codes() if invoice is not None else None
+    porad_cis = row.get("porad_cis") if isinstance(row, dict) else None
+    return {
+        "line": number,
+        "porad_cis": None if porad_cis is None else str(porad_cis),
+        "bkp": codes.bkp if codes is not None else None,
+        "pkp": codes.pkp if codes is not None else None,
+        "fik": codes.fik if codes is not None else None,
+        "status": status if status is not None else _status(resp),
+        "kod": resp.Chyba["kod"] if resp is not None else None,
+        "error": error if error is not None else (resp.Chyba["text"] if resp is not None else None)
+    }
+
+
+def _written(path):
+    '''
+    Line number of the last result in the output file, 0 if there is none
+
+    A result cut short by a crash is removed from the end of the file.
+    '''
+    if not os.path.exists(path):
+        return 0
+    line = 0
+    with open(path, "r+b") as f:
+        end = 0
+        for text in f:
+            if not text.endswith(b"\n"):
+                break
+            try:
+                line = json.loads(text)["line"]
+            except (ValueError, KeyError, TypeError):
+                break
+            end += len(text)
+        f.truncate(end)
+    return line
+
+
+class _Checkpoint:
+    '''
+    Line number of the last receipt whose result is written
+    '''
+
+    def __init__(self, path):
+        self.path = path
+
+    def read(self):
+        if self.path is None or not os.path.exists(self.path):
+            return 0
+        with open(self.path) as f:
+            return int(f.read().strip() or 0)
+
+    def write(self, number):
+        if self.path is None:
+            return
+        tmp = self.path + ".tmp"
+        with open(tmp, "w") as f:
+            f.write(str(number))
+        os.replace(tmp, self.path)
+
+
+def submit(factory, rows, output, checkpoint=None, concurrency=8, send=True, sender=None, progress=None, every=10):
+    '''
+    Sign and send receipts of rows, write one JSON result per receipt
+
+    At most 2 * concurrency receipts are in flight, results are written in
+    the order of rows. Output is flushed and the checkpoint saved after
+    every batch of written results, so the run can be resumed after a
+    crash; receipts in flight are written before an exception leaves.
+    progress is reported every `every` seconds. Returns count of results.
+
+    A resumed run does not send pending receipts again, pass a sender
+    that queues them, e.g. Scheduler(queue=storage.SqliteQueue(...)).process.
+    '''
+    sender = sender if sender is not None else remote.Scheduler.send
+    checkpoint = checkpoint if checkpoint is not None else _Checkpoint(None)
+
+    def process(item):
+        number, row = item
+        try:
+            row = _parse(row)
+            invoice = factory.from_dict(row, require_date=True)
+        except KeyError as e:
+            return _result(number, row, error="missing " + str(e), status="invalid")
+        except (ValueError, TypeError) as e:
+            return _result(number, row, error=str(e), status="invalid")
+        try:
+            if not send:
+                invoice.sign()
+                return _result(number, row, invoice)
+            return _result(number, row, invoice, sender(invoice))
+        except Exception as e:
+            # e.g. a response that fails validation, the receipt has to be sent again
+            return _result(number, row, invoice, error=str(e), status="failed")
+
+    done = 0
+    start = last = time.monotonic()
+    window = collections.deque()
+
+    def finish(future):
+        nonlocal done
+        result = future.result()
+        output.write(json.dumps(result, separators=(",", ":")) + "\n")
+        done += 1
+        return result["line"]
+
+    def save(line):
+        nonlocal last
+        # output first: a crash in between leaves the checkpoint behind, and
+        # resuming skips the lines found in the output anyway
+        output.flush()
+        checkpoint.write(line)
+        now = time.monotonic()
+        if progress is not None and now - last >= every:
+            progress(done, now - start)
+            last = now
+
+    with ThreadPoolExecutor(concurrency) as pool:
+        try:
+            for item in rows:
+                window.append(pool.submit(process, item))
+                line = None
+                while len(window) >= 2 * concurrency or window and window[0].done():
+                    line = finish(window.popleft())
+                if line is not None:
+                    save(line)
+        finally:
+            # e.g. an unreadable input, the receipts in flight may be sent already
+            line = None
+            while window:
+                line = finish(window.popleft())
+            if line is not None:
+                save(line)
+    output.flush()
+    if progress is not None:
+        progress(done, time.monotonic() - start)
+    return done
+
+
+def _progress(done, elapsed):
+    print("{0} receipts in {1:.1f} s, {2:.1f}/s".format(done, elapsed, done / elapsed if elapsed else 0), file=sys.stderr)
+
+def _config(args):
+    private_key = helpers.load_key(args.key, args.password.encode() if args.password else None)
+    return invoices.Config(helpers.load_cert(args.cert), private_key, args.id_provoz, args.id_pokl, args.dic_poverujiciho)
+
+def _submit(args):
+    from . import storage
+
+    config = _config(args)
+    factory = invoices.Factory(config)
+
+    fmt = args.format
+    if fmt is None:
+        fmt = "csv" if args.input.endswith(".csv") else "jsonl"
+
+    checkpoint = _Checkpoint(args.checkpoint)
+    skip = 0
+    if args.checkpoint:
+        skip = checkpoint.read()
+        if args.output != "-":
+            skip = max(skip, _written(args.output))
+
+    http = transport.Transport(pool_size=args.concurrency, connect_timeout=args.timeout, read_timeout=args.timeout)
+    queue = None
+    if args.queue:
+        # receipts not accepted are kept and resent by the daemon or a scheduler
+        queue = storage.SqliteQueue(args.queue, config)
+        sender = remote.Scheduler(http, queue=queue).process
+    else:
+        sender = lambda invoice: remote.Scheduler.send(invoice, http)
+    stream = sys.stdin if args.input == "-" else open(args.input, newline="", encoding="utf-8")
+    output = sys.stdout if args.output == "-" else open(args.output, "a" if skip else "w", encoding="utf-8")
+    try:
+        rows = itertools.dropwhile(lambda item: item[0] <= skip, _rows(stream, fmt))
+        submit(
+            factory,
+            rows,
+            output,
+            checkpoint,
+            args.concurrency,
+            not args.sign_only,
+            sender,
+            None if args.quiet else _progress
+        )
+    finally:
+        http.close()
+        if queue is not None:
+            queue.close()
+        if stream is not sys.stdin:
+            stream.close()
+        if output is not sys.stdout:
+            output.close()
+
+def _serve(args):
+    from . import daemon, storage
+
+    config = _config(args)
+    kwargs = {}
+    if args.queue:
+        kwargs["queue"] = storage.SqliteQueue(args.queue, config)
+    if args.store:
+        kwargs["store"] = storage.FikStore(args.store)
+    http = transport.Transport(pool_size=args.concurrency, connect_timeout=args.timeout, read_timeout=args.timeout)
+    address = ("127.0.0.1", args.port) if args.port else args.socket
+    token = None
+    if args.token_file:
+        with open(args.token_file, encoding="utf-8") as f:
+            token = f.read().strip()
+    server = daemon.Daemon(
+        invoices.Factory(config),
+        address,
+        token=token,
+        transport=http,
+        workers=args.concurrency,
+        interval=args.interval,
+        concurrency=args.concurrency,
+        **kwargs
+    )
+    if not args.quiet:
+        print("listening on {0}".format(server.address), file=sys.stderr)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.close()
+        http.close()
+
+def _config_arguments(cmd):
+    cmd.add_argument("--cert", required=True, help="PEM certificate")
+    cmd.add_argument("--key", required=True, help="PEM private key")
+    cmd.add_argument("--password", help="password of the private key")
+    cmd.add_argument("--id-provoz", required=True, type=int)
+    cmd.add_argument("--id-pokl", required=True)
+    cmd.add_argument("--dic-poverujiciho")
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m eet")
+    commands = parser.add_subparsers(dest="command")
+    commands.required = True
+
+    cmd = commands.add_parser("submit", help="sign and send receipts from a CSV or JSONL file")
+    cmd.add_argument("input", help="CSV or JSONL file with receipts, - for stdin")
+    _config_arguments(cmd)
+    cmd.add_argument("--format", choices=("csv", "jsonl"), help="input format, by default csv for *.csv and jsonl otherwise")
+    cmd.add_argument("--output", default="-", help="JSONL file with results, - for stdout")
+    cmd.add_argument("--checkpoint", help="file with the last processed line, continue after it if it exists")
+    cmd.add_argument("--concurrency", type=int, default=8, help="receipts sent at once")
+    cmd.add_argument("--timeout", type=float, default=3, help="connect and read timeout in seconds")
+    cmd.add_argument("--queue", help="SQLite file keeping receipts that were not accepted, resend them with serve --queue")
+    cmd.add_argument("--sign-only", action="store_true", help="compute PKP and BKP without sending")
+    cmd.add_argument("--quiet", action="store_true", help="do not report progress")
+    cmd.set_defaults(run=_submit)
+
+    cmd = commands.add_parser("serve", help="sign and send receipts for other processes, see eet.daemon")
+    _config_arguments(cmd)
+    where = cmd.add_mutually_exclusive_group(required=True)
+    where.add_argument("--socket", help="path of the Unix socket")
+    where.add_argument("--port", type=int, help="listen on this port of 127.0.0.1 instead, needs --token-file")
+    cmd.add_argument("--token-file", help="file with the secret clients have to send first")
+    cmd.add_argument("--queue", help="SQLite file keeping unsent invoices across restarts")
+    cmd.add_argument("--store", help="SQLite file recording sent invoices, enables lookups")
+    cmd.add_argument("--concurrency", type=int, default=8, help="receipts sent at once")
+    cmd.add_argument("--interval", type=float, default=60, help="seconds between resending passes")
+    cmd.add_argument("--timeout", type=float, default=3, help="connect and read timeout in seconds")
+    cmd.add_argument("--quiet", action="store_true", help="do not print the address")
+    cmd.set_defaults(run=_serve)
+
+    args = parser.parse_args(argv)
+    if args.concurrency < 1:
+        parser.error("concurrency must be at least 1")
+    if args.command == "submit" and args.queue and args.sign_only:
+        parser.error("--queue needs sending")
+    if args.command == "serve" and args.port and not args.token_file:
+        parser.error("--port needs --token-file")
+    args.run(args)
@@ -0,0 +1,334 @@
+from concurrent.futures import Future
+from decimal import Decimal
+
+import errno
+import hmac
+import json
+import os
+import socket
+import socketserver
+import stat
+import threading
+
+'''
+Signing and sending daemon shared by many processes
+
+One process holds the key, the connection pool and the retry queue, point
+of sale processes talk to it over a Unix socket (or localhost TCP) with
+JSON lines. Every request carries an id chosen by the client:
+
+    {"id": 1, "op": "submit", "receipt": {"porad_cis": "1", "celk_trzba": "100.00"}}
+    {"id": 1, "bkp": "...", "pkp": "..."}       reply, sent at once
+    {"id": 1, "fik": "..."}                     sent when the invoice is accepted
+    {"id": 1, "error": "...", "kod": 4}         or rejected for good
+
+    {"id": 2, "op": "lookup", "bkp": "..."}     needs a FikStore
+    {"id": 2, "fik": "...", "status": "accepted", ...}
+
+A daemon with a token (always on TCP, any local user can connect there)
+closes the connection unless its first request is
+
+    {"id": 0, "op": "auth", "token": "..."}
+    {"id": 0}
+
+Receipts are read by Factory.from_dict: the arguments of Factory.new,
+amounts as strings or numbers and dat_trzby in the EET format (now if left out). Errors are {"id": 1, "error": "..."}.
+Client only needs the standard library, so workers do not load lxml or
+cryptography.
+'''
+
+def _address(address):
+    # path of a Unix socket or (host, port)
+    return address if isinstance(address, tuple) else os.fspath(address)
+
+def _remove_stale(path):
+    # a socket left by a daemon that did not exit cleanly, never other files
+    try:
+        if not stat.S_ISSOCK(os.stat(path).st_mode):
+            return
+    except FileNotFoundError:
+        return
+    probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        probe.connect(path)
+    except OSError:
+        os.unlink(path)
+    else:
+        raise OSError(errno.EADDRINUSE, "a daemon is already listening", path)
+    finally:
+        probe.close()
+
+def _encode(message):
+    return (json.dumps(message, separators=(",", ":"), default=str) + "\n").encode("utf-8")
+
+
+class _Handler(socketserver.StreamRequestHandler):
+
+    def setup(self):
+        super().setup()
+        self._lock = threading.Lock()
+        self._open = True
+        self._authenticated = self.server.daemon._token is None
+
+    def handle(self):
+        for line in self.rfile:
+            if not line.strip():
+                continue
+            try:
+                request = json.loads(line, parse_float=Decimal)
+            except ValueError as e:
+                self._reply({"id": None, "error": "invalid request: " + str(e)})
+                continue
+            if isinstance(request, dict) and request.get("op") == "auth":
+                self._authenticated = self.server.daemon._authenticate(request.get("token"))
+                self._reply({"id": request.get("id")} if self._authenticated else {"id": request.get("id"), "error": "invalid token"})
+            elif self._authenticated:
+                self.server.daemon.handle(request, self._reply)
+            else:
+                self._reply({"id": request.get("id") if isinstance(request, dict) else None, "error": "authentication required"})
+            if not self._authenticated:
+                return
+
+    def finish(self):
+        with self._lock:
+            self._open = False
+        super().finish()
+
+    def _reply(self, message):
+        # FIKs arrive from other threads, possibly after the client is gone
+        with self._lock:
+            if not self._open:
+                return
+            try:
+                self.wfile.write(_encode(message))
+                self.wfile.flush()
+            except OSError:
+                self._open = False
+
+
+class _UnixServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+class _TCPServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class Daemon:
+    '''
+    Serves one Factory to many clients
+
+    Invoices are sent by a single Sender, keyword arguments are passed to
+    it (and on to Scheduler), e.g. queue=storage.SqliteQueue(...) keeps
+    unsent invoices across restarts and store=storage.FikStore(...)
+    enables lookups. The Unix socket is created with mode. Clients have
+    to send token first, it is required on TCP.
+    '''
+
+    def __init__(self, factory, address, mode: int = 0o600, token: str = None, **kwargs):
+        from . import remote
+
+        address = _address(address)
+        if isinstance(address, tuple) and not token:
+            raise ValueError("listening on TCP needs a token")
+        self._factory = factory
+        self._token = token
+        self._store = kwargs.get("store")
+        if isinstance(address, tuple):
+            self._server = _TCPServer(address, _Handler)
+        else:
+            _remove_stale(address)
+            # nobody else may connect before the chmod, umask is per process though
+            umask = os.umask(0o177)
+            try:
+                self._server = _UnixServer(address, _Handler)
+            finally:
+                os.umask(umask)
+            os.chmod(address, mode)
+        self._sender = remote.Sender(**kwargs)
+        self._server.daemon = self
+        self.address = self._server.server_address
+
+    def handle(self, request, reply):
+        '''
+        Answer one request, reply(message) sends a message to its client
+        '''
+        if not isinstance(request, dict):
+            reply({"id": None, "error": "invalid request"})
+            return
+        id = request.get("id")
+        op = request.get("op", "submit")
+        try:
+            if op == "submit":
+                self._submit(id, request["receipt"], reply)
+            elif op == "lookup":
+                reply(self._lookup(id, request["bkp"]))
+            else:
+                reply({"id": id, "error": "unknown op " + str(op)})
+        except KeyError as e:
+            reply({"id": id, "error": "missing " + str(e)})
+        except Exception as e:
+            reply({"id": id, "error": str(e)})
+
+    def _authenticate(self, token):
+        if self._token is None:
+            return True
+        return isinstance(token, str) and hmac.compare_digest(token.encode("utf-8"), self._token.encode("utf-8"))
+
+    def _submit(self, id, receipt, reply):
+        invoice = self._factory.from_dict(receipt)
+        future = self._sender.submit(invoice)
+        codes = invoice.codes()
+        # the codes go out first, the FIK callback may run at once
+        reply({"id": id, "bkp": codes.bkp, "pkp": codes.pkp})
+
+        def done(future):
+            try:
+                resp = future.result()
+            except Exception as e:
+                reply({"id": id, "error": str(e)})
+                return
+            if resp:
+                reply({"id": id, "fik": resp.codes().fik})
+            else:
+                reply({"id": id, "error": "rejected {0}: {1}".format(resp.Chyba["kod"], resp.Chyba["text"]), "kod": resp.Chyba["kod"]})
+
+        future.add_done_callback(done)
+
+    def _lookup(self, id, bkp):
+        if self._store is None:
+            return {"id": id, "error": "lookup needs a store"}
+        receipt = self._store.get(bkp)
+        if receipt is None:
+            return {"id": id, "error": "unknown bkp"}
+        return {
+            "id": id,
+            "bkp": receipt.bkp,
+            "pkp": receipt.pkp,
+            "porad_cis": receipt.porad_cis,
+            "fik": receipt.fik,
+            "status": receipt.status,
+            "kod": receipt.kod
+        }
+
+    def serve_forever(self):
+        self._server.serve_forever()
+
+    def close(self, wait: bool = True):
+        '''
+        Stop serving, invoices not accepted yet stay in the queue
+        '''
+        self._server.shutdown()
+        self._server.server_close()
+        self._sender.close(wait)
+        if self._store is not None:
+            self._store.flush()
+        if isinstance(self.address, str) and os.path.exists(self.address):
+            os.unlink(self.address)
+
+
+class DaemonError(Exception):
+    pass
+
+
+class Client:
+    '''
+    Connection to a Daemon, safe to share between threads
+
+    submit() returns the codes at once and a Future resolved with the FIK.
+    FIKs of receipts still waiting when the connection closes are lost to
+    this client; lookup() finds them later when the daemon has a store.
+    token is sent first when the daemon requires one.
+    '''
+
+    def __init__(self, address, timeout: float = 10, token: str = None):
+        address = _address(address)
+        family = socket.AF_INET if isinstance(address, tuple) else socket.AF_UNIX
+        self._sock = socket.socket(family, socket.SOCK_STREAM)
+        self._sock.settimeout(timeout)
+        self._sock.connect(address)
+        self._sock.settimeout(None)
+        self._timeout = timeout
+        self._lock = threading.Lock()
+        self._next = 0
+        # id: [Future of the reply, Future of the FIK or None]
+        self._pending = {}
+        self._reader = threading.Thread(target=self._read, daemon=True)
+        self._reader.start()
+        if token is not None:
+            try:
+                self._request({"op": "auth", "token": token}, False)
+            except Exception:
+                self.close()
+                raise
+
+    def submit(self, receipt: dict):
+        '''
+        ({"bkp": ..., "pkp": ...}, Future of the FIK)
+        '''
+        reply, fik = self._request({"op": "submit", "receipt": receipt}, True)
+        return {"bkp": reply["bkp"], "pkp": reply["pkp"]}, fik
+
+    def lookup(self, bkp: str):
+        reply, _ = self._request({"op": "lookup", "bkp": bkp}, False)
+        del reply["id"]
+        return reply
+
+    def close(self):
+        try:
+            self._sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self._sock.close()
+        self._reader.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def _request(self, message, later):
+        reply = Future()
+        fik = Future() if later else None
+        with self._lock:
+            self._next += 1
+            message["id"] = self._next
+            self._pending[self._next] = [reply, fik]
+            self._sock.sendall(_encode(message))
+        result = reply.result(self._timeout)
+        if "error" in result:
+            raise DaemonError(result["error"])
+        return result, fik
+
+    def _read(self):
+        try:
+            for line in self._sock.makefile("rb"):
+                message = json.loads(line)
+                with self._lock:
+                    futures = self._pending.get(message.get("id"))
+                    if futures is None:
+                        continue
+                    reply, fik = futures
+                    futures[0] = None
+                    # no FIK comes after a failed submit
+                    if reply is None or fik is None or "error" in message:
+                        del self._pending[message["id"]]
+                if reply is not None:
+                    reply.set_result(message)
+                    if fik is not None and "error" in message:
+                        fik.set_exception(DaemonError(message["error"]))
+                elif "error" in message:
+                    fik.set_exception(DaemonError(message["error"]))
+                else:
+                    fik.set_result(message["fik"])
+        except (OSError, ValueError):
+            pass
+        finally:
+            with self._lock:
+                pending, self._pending = self._pending, {}
+            for futures in pending.values():
+                for future in futures:
+                    if future is not None:
+                        future.set_exception(DaemonError("connection closed"))
@@ -1,4 +1,3 @@
-import urllib.request
 import shutil
 from datetime import datetime
 
@@ -29,6 +28,8 @@ def parse_key(content, password=None):
     return serialization.load_pem_private_key(content, password, default_backend())
 
 def download(filename: str, url: str):
+    # urllib.request is slow to import and rarely needed
+    import urllib.request
     with urllib.request.urlopen(url) as response, open(filename, 'wb') as out_file:
         shutil.copyfileobj(response, out_file)
 
@@ -1,28 +1,66 @@
-from . import binding, types, helpers, remote
+from . import records, types, monitoring
 
-from datetime import datetime
+from datetime import datetime, timezone
+from decimal import Decimal, InvalidOperation
 from pathlib import Path
+from typing import TYPE_CHECKING
 
 import uuid
 import base64
 import hashlib
 
-from cryptography.x509 import Certificate, oid
-from cryptography.hazmat.primitives import hashes
-from cryptography.hazmat.primitives.asymmetric import padding
-from cryptography.hazmat.primitives.asymmetric.rsa import RSAPrivateKey
+# lxml and cryptography are loaded by the first Config, importing invoices stays cheap
+if TYPE_CHECKING:
+    from cryptography.x509 import Certificate
+    from cryptography.hazmat.primitives.asymmetric.rsa import RSAPrivateKey
+
+
+# optional amounts of an invoice, keyword arguments of Factory.new
+_AMOUNTS = (
+    "zakl_nepodl_dph",
+    "zakl_dan1",
+    "dan1",
+    "zakl_dan2",
+    "dan2",
+    "zakl_dan3",
+    "dan3",
+    "cest_sluz",
+    "pouzit_zboz1",
+    "pouzit_zboz2",
+    "pouzit_zboz3",
+    "urceno_cerp_zuct",
+    "cerp_zuct"
+)
+
+def _amount(val):
+    if isinstance(val, str):
+        try:
+            return Decimal(val.strip())
+        except InvalidOperation:
+            raise ValueError("could not convert " + val)
+    return val
+
+def _date(val):
+    # EET format with offset, e.g. 2019-08-11T10:00:05+02:00, kept as UTC wall time
+    date = types.dateTime(val).astimezone(timezone.utc)
+    return types.dateTime(date.year, date.month, date.day, date.hour, date.minute, date.second)
 
 
 class Config:
 
     def __init__(
         self,
-        cert: Certificate,
-        private_key: RSAPrivateKey,
+        cert: "Certificate",
+        private_key: "RSAPrivateKey",
         id_provoz: types.IdProvozType,
         id_pokl: types.string20,
-        dic_poverujiciho: types.CZDICType = None
+        dic_poverujiciho: types.CZDICType = None,
+        metrics: monitoring.Metrics = None
     ):
+        from . import binding, helpers
+        from cryptography.x509 import Certificate, oid
+        from cryptography.hazmat.primitives.asymmetric.rsa import RSAPrivateKey
+
         if not isinstance(cert, Certificate):
             raise ValueError("invalid certificate")
         
@@ -57,6 +95,10 @@ class Config:
         if not isinstance(private_key, RSAPrivateKey):
             raise ValueError("invalid private key")
         self._private_key = private_key
+
+        # long-lived signer shared by all invoices built with this config
+        self._soap = binding.Soap(cert, private_key)
+        self._metrics = metrics if metrics is not None else monitoring.Metrics()
     
     def get(self, val):
         if val in self._val:
@@ -75,65 +117,105 @@ class Config:
     
     def private_key(self):
         return self._private_key
+    
+    def soap(self):
+        return self._soap
+
+    def metrics(self):
+        return self._metrics
 
 
 class Factory:
 
     class Codes:
-        bkp: types.BkpType = None
-        pkp: types.PkpType = None
-        fik: types.FikType = None
+        __slots__ = ("bkp", "pkp", "fik")
+        bkp: types.BkpType
+        pkp: types.PkpType
+        fik: types.FikType
+
+        def __init__(self):
+            self.bkp = None
+            self.pkp = None
+            self.fik = None
 
-    class Invoice(binding.Trzba):
+    class Invoice(records.Trzba):
         def __init__(self, config: Config):
-            super()
+            super().__init__()
             self._config = config
             self._codes = Factory.Codes()
+            # data PKP was computed from
+            self._signed = None
 
         def _buildXml(self):
-            return binding.Soap(self._config.cert(), self._config.private_key()).build(self)
+            with self._config.metrics().timer("build"):
+                return self._config.soap().build(self)
         
         def _prepare(self):
-            if self.Hlavicka["prvni_zaslani"] or not self.Hlavicka["dat_odesl"]:
-                self.Hlavicka["dat_odesl"] = types.dateTime.utcnow()
+            # every message, resends included, has its own send time and uuid
+            self.Hlavicka["dat_odesl"] = types.dateTime.utcnow()
             self.Hlavicka["uuid_zpravy"] = types.UUIDType(str(uuid.uuid4()))
 
-            sign = self._calc_sign()
-            self._codes.pkp = self.Codes["pkp"] = types.PkpType(base64.b64encode(sign).decode())
-            self._codes.bkp = self.Codes["bkp"] = types.BkpType(self._calc_bkp(sign))
-        
-        def _calc_sign(self):
-            text = "{0}|{1}|{2}|{3}|{4}|{5}".format(
+            # PKP and BKP stay the same on resend, sign again only if signed data changed
+            text = self._sign_text()
+            if text == self._signed and self._codes.pkp is not None:
+                return
+            with self._config.metrics().timer("sign"):
+                sign = self._config.soap().sign(text)
+                self._restore(types.PkpType(base64.b64encode(sign).decode()), types.BkpType(self._calc_bkp(sign)))
+
+        def _sign_text(self):
+            return "{0}|{1}|{2}|{3}|{4}|{5}".format(
                 self.Data["dic_popl"],
                 self.Data["id_provoz"],
                 self.Data["id_pokl"],
                 self.Data["porad_cis"],
                 self.Data["dat_trzby"],
                 self.Data["celk_trzba"]
-            )
-            return self._config.private_key().sign(text.encode('utf8'), padding.PKCS1v15(), hashes.SHA256())
+            ).encode('utf8')
+
+        def _restore(self, pkp, bkp):
+            self._codes.pkp = self.Codes["pkp"] = pkp
+            self._codes.bkp = self.Codes["bkp"] = bkp
+            self._signed = self._sign_text()
         
         @staticmethod
         def _calc_bkp(sign):
             digest = hashlib.sha1(sign).hexdigest()
             return ("{0}-{1}-{2}-{3}-{4}".format(digest[0:8], digest[8:16], digest[16:24], digest[24:32], digest[32:])).upper()
         
+        def sign(self):
+            '''
+            Compute PKP and BKP without building the message
+            '''
+            self._prepare()
+            return self._codes
+
         def build(self):
             self._prepare()
             return self._buildXml()
 
         def send(self):
+            # remote is only needed to send invoices, import it on first use
+            from . import remote
             return remote.Scheduler.send(self)
+
+        async def send_async(self):
+            from . import remote
+            return await remote.AsyncScheduler.send(self)
         
         def prod(self):
             return self._config.prod()
+
+        def metrics(self):
+            return self._config.metrics()
         
         def codes(self):
             return self._codes
     
-    class Response(binding.Odpoved):
+    class Response(records.Odpoved):
         def __init__(self, codes, obj = None):
-            if isinstance(obj, binding.Odpoved):
+            super().__init__()
+            if isinstance(obj, records.Odpoved):
                 self.Hlavicka = obj.Hlavicka
                 self.Potvrzeni = obj.Potvrzeni
                 self.Chyba = obj.Chyba
@@ -144,6 +226,13 @@ class Factory:
         
         def __bool__(self):
             return self.Potvrzeni["fik"] is not None
+
+        def rejected(self):
+            '''
+            Rejected for good: positive error codes are final, sending the
+            same message again cannot help; -1 is a temporary error
+            '''
+            return not self and self.Chyba["kod"] is not None and self.Chyba["kod"] > 0
         
         def codes(self):
             return self._codes
@@ -157,7 +246,7 @@ class Factory:
         self,
         porad_cis: types.string25,
         celk_trzba: types.CastkaType,
-        dat_trzby: types.dateTime = types.dateTime.utcnow(),
+        dat_trzby: types.dateTime = None,
         **kwargs: types.CastkaType
     ):
         sale = self.Invoice(self._config)
@@ -176,28 +265,87 @@ class Factory:
         sale.Data["porad_cis"] = types.string25(porad_cis)
         sale.Data["celk_trzba"] = types.CastkaType(celk_trzba)
 
-        if not isinstance(dat_trzby, types.dateTime):
+        if dat_trzby is None:
+            dat_trzby = types.dateTime.utcnow()
+        elif not isinstance(dat_trzby, types.dateTime):
             raise ValueError("invalid date")
         sale.Data["dat_trzby"] = dat_trzby
         
         sale.Data["rezim"] = types.RezimType(1 if self._config.play() else 0)
 
-        for price in [
-            "zakl_nepodl_dph",
-            "zakl_dan1",
-            "dan1",
-            "zakl_dan2",
-            "dan2",
-            "zakl_dan3",
-            "dan3",
-            "cest_sluz",
-            "pouzit_zboz1",
-            "pouzit_zboz2",
-            "pouzit_zboz3",
-            "urceno_cerp_zuct",
-            "cerp_zuct"
-        ]:
+        for price in _AMOUNTS:
             if price in kwargs:
                 sale.Data[price] = types.CastkaType(kwargs[price])
 
         return sale
+
+    def from_dict(self, receipt: dict, require_date: bool = False):
+        '''
+        New invoice from a receipt read from JSON or CSV
+
+        Keys are the arguments of new(), amounts may be strings and
+        dat_trzby is in the EET format (2019-08-11T10:00:05+02:00); empty
+        values are left out. Without dat_trzby the invoice is made now,
+        unless require_date, then KeyError is raised: a file sent again
+        later must produce the same BKP.
+        '''
+        if not isinstance(receipt, dict):
+            raise ValueError("receipt is not an object")
+        kwargs = {k: _amount(receipt[k]) for k in _AMOUNTS if receipt.get(k) not in (None, "")}
+        dat_trzby = receipt.get("dat_trzby")
+        if not dat_trzby and require_date:
+            raise KeyError("dat_trzby")
+        return self.new(
+            str(receipt["porad_cis"]),
+            _amount(receipt["celk_trzba"]),
+            _date(dat_trzby) if dat_trzby else None,
+            **kwargs
+        )
+
+    def new_many(self, specs, workers: int = None, chunksize: int = 16):
+        '''
+        Build and sign many invoices on a pool of worker processes
+
+        specs is an iterable of dicts with arguments of new(). Returns list
+        of (invoice, envelope) in the order of specs, envelope being the
+        signed SOAP message. Each worker loads the key once.
+        '''
+        from . import storage
+        from cryptography.hazmat.primitives import serialization
+
+        import concurrent.futures
+
+        initargs = (
+            self._config.cert().public_bytes(serialization.Encoding.PEM),
+            self._config.private_key().private_bytes(
+                serialization.Encoding.PEM,
+                serialization.PrivateFormat.PKCS8,
+                serialization.NoEncryption()
+            ),
+            self._config.get("id_provoz"),
+            self._config.get("id_pokl"),
+            self._config.get("dic_poverujiciho")
+        )
+        with concurrent.futures.ProcessPoolExecutor(workers, initializer=_init_worker, initargs=initargs) as pool:
+            return [
+                (storage.load(self._config, text), xml)
+                for text, xml in pool.map(_sign_worker, specs, chunksize=chunksize)
+            ]
+
+
+# factory of the current worker process of Factory.new_many
+_worker_factory = None
+
+def _init_worker(cert, private_key, id_provoz, id_pokl, dic_poverujiciho):
+    from . import helpers
+
+    global _worker_factory
+    config = Config(helpers.parse_cert(cert), helpers.parse_key(private_key), id_provoz, id_pokl, dic_poverujiciho)
+    _worker_factory = Factory(config)
+
+def _sign_worker(spec):
+    from . import storage
+
+    invoice = _worker_factory.new(**spec)
+    envelope = invoice.build()
+    return storage.dump(invoice), envelope
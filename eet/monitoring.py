@@ -0,0 +1,162 @@
+import bisect
+import threading
+import time
+
+'''
+Metrics hooks called while invoices are signed, built, sent and parsed
+
+Stages are "sign" (PKP and BKP), "build" (signed SOAP envelope),
+"request" (round trip to the gateway) and "parse" (response validation).
+'''
+
+class _Timer:
+
+    def __init__(self, metrics, stage):
+        self._metrics = metrics
+        self._stage = stage
+
+    def __enter__(self):
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self._metrics.observe(self._stage, time.perf_counter() - self._start)
+        return False
+
+
+class Metrics:
+    '''
+    Receives measurements and discards them, override what you need
+
+    Methods are called from scheduler worker threads and must be thread safe.
+    '''
+
+    def observe(self, stage, seconds):
+        pass
+
+    def queue_depth(self, depth):
+        pass
+
+    def retry(self):
+        pass
+
+    def error(self, code):
+        '''
+        code is types.KodChybaType, or None when the gateway did not answer
+        '''
+        pass
+
+    def warning(self, code):
+        pass
+
+    def exception(self, exc):
+        '''
+        Sending raised exc, e.g. a response that failed validation
+        '''
+        pass
+
+    def timer(self, stage):
+        return _Timer(self, stage)
+
+
+class Aggregator(Metrics):
+    '''
+    Keeps measurements in memory and renders them in Prometheus text format
+
+    Durations are collected into histograms with the given bucket bounds
+    in seconds.
+    '''
+
+    BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = tuple(sorted(buckets))
+        self._histograms = {}
+        self._depth = 0
+        self._retries = 0
+        self._errors = {}
+        self._warnings = {}
+        self._exceptions = {}
+        self._lock = threading.Lock()
+
+    def observe(self, stage, seconds):
+        i = bisect.bisect_left(self.buckets, seconds)
+        with self._lock:
+            if stage not in self._histograms:
+                # [counts per bucket, sum, count]
+                self._histograms[stage] = [[0] * len(self.buckets), 0.0, 0]
+            histogram = self._histograms[stage]
+            if i < len(self.buckets):
+                histogram[0][i] += 1
+            histogram[1] += seconds
+            histogram[2] += 1
+
+    def queue_depth(self, depth):
+        self._depth = depth
+
+    def retry(self):
+        with self._lock:
+            self._retries += 1
+
+    def error(self, code):
+        code = "none" if code is None else str(code)
+        with self._lock:
+            self._errors[code] = self._errors.get(code, 0) + 1
+
+    def warning(self, code):
+        code = "none" if code is None else str(code)
+        with self._lock:
+            self._warnings[code] = self._warnings.get(code, 0) + 1
+
+    def exception(self, exc):
+        name = type(exc).__name__
+        with self._lock:
+            self._exceptions[name] = self._exceptions.get(name, 0) + 1
+
+    def prometheus(self):
+        '''
+        Snapshot of all metrics in Prometheus text exposition format
+        '''
+        with self._lock:
+            histograms = {stage: (list(h[0]), h[1], h[2]) for stage, h in self._histograms.items()}
+            retries = self._retries
+            errors = dict(self._errors)
+            warnings = dict(self._warnings)
+            exceptions = dict(self._exceptions)
+
+        lines = [
+            "# HELP eet_stage_duration_seconds Time spent in a stage of sending an invoice",
+            "# TYPE eet_stage_duration_seconds histogram"
+        ]
+        for stage in sorted(histograms):
+            counts, total, count = histograms[stage]
+            cumulative = 0
+            for bound, n in zip(self.buckets, counts):
+                cumulative += n
+                lines.append('eet_stage_duration_seconds_bucket{{stage="{0}",le="{1}"}} {2}'.format(stage, bound, cumulative))
+            lines.append('eet_stage_duration_seconds_bucket{{stage="{0}",le="+Inf"}} {1}'.format(stage, count))
+            lines.append('eet_stage_duration_seconds_sum{{stage="{0}"}} {1}'.format(stage, total))
+            lines.append('eet_stage_duration_seconds_count{{stage="{0}"}} {1}'.format(stage, count))
+
+        lines += [
+            "# HELP eet_queue_depth Invoices waiting to be resent",
+            "# TYPE eet_queue_depth gauge",
+            "eet_queue_depth {0}".format(self._depth),
+            "# HELP eet_retries_total Attempts to resend a queued invoice",
+            "# TYPE eet_retries_total counter",
+            "eet_retries_total {0}".format(retries),
+            "# HELP eet_errors_total Rejected invoices by error code, none when the gateway did not answer",
+            "# TYPE eet_errors_total counter"
+        ]
+        lines += ['eet_errors_total{{code="{0}"}} {1}'.format(code, errors[code]) for code in sorted(errors)]
+        lines += [
+            "# HELP eet_warnings_total Accepted invoices with a warning by warning code",
+            "# TYPE eet_warnings_total counter"
+        ]
+        lines += ['eet_warnings_total{{code="{0}"}} {1}'.format(code, warnings[code]) for code in sorted(warnings)]
+        lines += [
+            "# HELP eet_exceptions_total Exceptions raised while sending by type",
+            "# TYPE eet_exceptions_total counter"
+        ]
+        lines += ['eet_exceptions_total{{type="{0}"}} {1}'.format(name, exceptions[name]) for name in sorted(exceptions)]
+        return "\n".join(lines) + "\n"
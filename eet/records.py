@@ -0,0 +1,153 @@
+'''
+Plain records of the EET messages
+
+Kept apart from binding, which needs lxml and cryptography, so invoices
+can be created and inspected without loading them.
+'''
+
+class Record:
+    '''
+    Fixed set of fields with dict-style access, stored in __slots__
+
+    Subclasses list their fields in __slots__, all default to None.
+    '''
+    __slots__ = ()
+
+    def __init__(self, **fields):
+        for key in self.__slots__:
+            object.__setattr__(self, key, None)
+        for key, val in fields.items():
+            self[key] = val
+
+    def __getitem__(self, key):
+        if key not in self.__slots__:
+            raise KeyError(key)
+        return getattr(self, key)
+
+    def __setitem__(self, key, val):
+        if key not in self.__slots__:
+            raise KeyError(key)
+        setattr(self, key, val)
+
+    def __contains__(self, key):
+        return key in self.__slots__
+
+    def __iter__(self):
+        return iter(self.__slots__)
+
+    def __len__(self):
+        return len(self.__slots__)
+
+    def __eq__(self, other):
+        if isinstance(other, Record):
+            other = dict(other.items())
+        return dict(self.items()) == other
+
+    def __repr__(self):
+        return repr(dict(self.items()))
+
+    def get(self, key, default=None):
+        return getattr(self, key) if key in self.__slots__ else default
+
+    def keys(self):
+        return self.__slots__
+
+    def values(self):
+        return [getattr(self, key) for key in self.__slots__]
+
+    def items(self):
+        return [(key, getattr(self, key)) for key in self.__slots__]
+
+class Trzba:
+
+    class Hlavicka(Record):
+        __slots__ = (
+            "uuid_zpravy", # types.UUIDType,
+            "dat_odesl", # types.dateTime,
+            "prvni_zaslani", # types.boolean,
+            "overeni" # Optional[types.boolean]
+        )
+
+    class Data(Record):
+        __slots__ = (
+            "dic_popl", # types.CZDICType,
+            "dic_poverujiciho", # Optional[types.CZDICType],
+            "id_provoz", # types.IdProvozType,
+            "id_pokl", # types.string20,
+            "porad_cis", # types.string25,
+            "dat_trzby", # types.dateTime,
+            "celk_trzba", # types.CastkaType,
+            "zakl_nepodl_dph", # Optional[types.CastkaType],
+            "zakl_dan1", # Optional[types.CastkaType],
+            "dan1", # Optional[types.CastkaType],
+            "zakl_dan2", # Optional[types.CastkaType],
+            "dan2", # Optional[types.CastkaType],
+            "zakl_dan3", # Optional[types.CastkaType],
+            "dan3", # Optional[types.CastkaType],
+            "cest_sluz", # Optional[types.CastkaType],
+            "pouzit_zboz1", # Optional[types.CastkaType],
+            "pouzit_zboz2", # Optional[types.CastkaType],
+            "pouzit_zboz3", # Optional[types.CastkaType],
+            "urceno_cerp_zuct", # Optional[types.CastkaType],
+            "cerp_zuct", # Optional[types.CastkaType],
+            "rezim" # types.RezimType
+        )
+
+    class Codes(Record):
+        __slots__ = (
+            "pkp", # types.PkpType
+            "bkp" # types.BkpType
+        )
+
+    # constant, shared by all instances
+    KontrolniKody = {
+        "pkp": {
+            "digest": "SHA256", # str
+            "cipher": "RSA2048", # str
+            "encoding": "base64" # str
+        },
+        "bkp": {
+            "digest": "SHA1", # str
+            "encoding": "base16" # str
+        }
+    }
+
+    def __init__(self):
+        self.Hlavicka = Trzba.Hlavicka()
+        self.Data = Trzba.Data()
+        self.Codes = Trzba.Codes()
+
+class Odpoved:
+
+    class Hlavicka(Record):
+        __slots__ = (
+            "uuid_zpravy", # Optional[types.UUIDType]
+            "bkp", # Optional[types.BkpType]
+            "dat_prij", # Optional[types.dateTime]
+            "dat_odmit" # Optional[types.dateTime]
+        )
+
+    class Potvrzeni(Record):
+        __slots__ = (
+            "fik", # types.FikType
+            "test" # Optional[types.boolean]
+        )
+
+    class Chyba(Record):
+        __slots__ = (
+            "kod", # types.KodChybaType
+            "test", # Optional[types.boolean],
+            "text" # str
+        )
+
+    class Varovani(Record):
+        __slots__ = (
+            "kod_varov", # Optional[types.KodVarovType]
+            "text" # str
+        )
+
+    def __init__(self):
+        self.Hlavicka = Odpoved.Hlavicka()
+        self.Potvrzeni = Odpoved.Potvrzeni()
+        self.Chyba = Odpoved.Chyba()
+        self.Varovani = Odpoved.Varovani()
@@ -0,0 +1,154 @@
+from . import invoices, helpers, types
+
+import collections
+import os
+import threading
+import time
+
+'''
+Configs of many tenants (shops, cash registers) served by one process
+'''
+
+class _Tenant:
+    __slots__ = ("stamp", "checked", "config", "factory")
+
+    def __init__(self, stamp, config):
+        self.stamp = stamp
+        self.checked = time.monotonic()
+        self.config = config
+        self.factory = invoices.Factory(config)
+
+
+class Registry:
+    '''
+    Creates Config and Factory of a tenant on first use and keeps them
+
+    Tenants are registered with paths to their PEM certificate and key,
+    or returned by loader(key) as a dict with the arguments of register.
+    At most size tenants are kept, the least recently used are dropped and
+    loaded again when needed. Files are checked every check_interval
+    seconds and the tenant is reloaded when they change. Tenants sharing
+    a certificate share its parsed key.
+
+    Invoices of all tenants can go through one scheduler, they are sent
+    over its single connection pool.
+    '''
+
+    def __init__(self, loader=None, size: int = 256, check_interval: float = 60):
+        if size < 1:
+            raise ValueError("size must be at least 1")
+        self._loader = loader
+        self.size = size
+        self.check_interval = check_interval
+        self._specs = {}
+        self._tenants = collections.OrderedDict()
+        # (cert path, key path) -> (stamp, cert, private key)
+        self._keys = collections.OrderedDict()
+        self._lock = threading.RLock()
+
+    def register(
+        self,
+        key,
+        cert: str,
+        private_key: str,
+        id_provoz: types.IdProvozType,
+        id_pokl: types.string20,
+        dic_poverujiciho: types.CZDICType = None,
+        password: bytes = None
+    ):
+        with self._lock:
+            self._specs[key] = {
+                "cert": cert,
+                "private_key": private_key,
+                "id_provoz": id_provoz,
+                "id_pokl": id_pokl,
+                "dic_poverujiciho": dic_poverujiciho,
+                "password": password
+            }
+            self._tenants.pop(key, None)
+
+    def remove(self, key):
+        with self._lock:
+            self._specs.pop(key, None)
+            self._tenants.pop(key, None)
+
+    def config(self, key) -> invoices.Config:
+        return self._tenant(key).config
+
+    def factory(self, key) -> invoices.Factory:
+        return self._tenant(key).factory
+
+    def clear(self):
+        '''
+        Drop all loaded tenants and keys, registrations are kept
+        '''
+        with self._lock:
+            self._tenants.clear()
+            self._keys.clear()
+
+    def _tenant(self, key):
+        with self._lock:
+            tenant = self._tenants.get(key)
+            if tenant is not None:
+                if time.monotonic() - tenant.checked < self.check_interval:
+                    self._tenants.move_to_end(key)
+                    return tenant
+                spec = self._spec(key)
+                if self._stamp(spec) == tenant.stamp:
+                    tenant.checked = time.monotonic()
+                    self._tenants.move_to_end(key)
+                    return tenant
+            else:
+                spec = self._spec(key)
+
+            stamp, cert, private_key = self._load(spec)
+            tenant = _Tenant(stamp, invoices.Config(
+                cert,
+                private_key,
+                spec["id_provoz"],
+                spec["id_pokl"],
+                spec.get("dic_poverujiciho")
+            ))
+            self._tenants[key] = tenant
+            self._tenants.move_to_end(key)
+            while len(self._tenants) > self.size:
+                self._tenants.popitem(last=False)
+            return tenant
+
+    def _spec(self, key):
+        if key not in self._specs:
+            if self._loader is None:
+                raise KeyError(key)
+            spec = self._loader(key)
+            if spec is None:
+                raise KeyError(key)
+            self.register(key, **spec)
+        return self._specs[key]
+
+    @staticmethod
+    def _stamp(spec):
+        cert = os.stat(spec["cert"])
+        private_key = os.stat(spec["private_key"])
+        return (cert.st_mtime_ns, cert.st_size, private_key.st_mtime_ns, private_key.st_size)
+
+    def _load(self, spec):
+        files = (spec["cert"], spec["private_key"])
+        stamp = self._stamp(spec)
+        entry = self._keys.get(files)
+        if entry is None or entry[0] != stamp:
+            entry = (
+                stamp,
+                helpers.load_cert(spec["cert"]),
+                helpers.load_key(spec["private_key"], spec.get("password"))
+            )
+            self._keys[files] = entry
+        self._keys.move_to_end(files)
+        while len(self._keys) > self.size:
+            self._keys.popitem(last=False)
+        return entry
+
+    def __contains__(self, key):
+        return key in self._specs
+
+    def __len__(self):
+        return len(self._specs)
@@ -1,46 +1,685 @@
-from . import invoices, binding, types
+from . import invoices, binding, types, transport, storage, monitoring
 
-from urllib import request, error
+from urllib import error
+from concurrent.futures import Future, ThreadPoolExecutor
 
+import asyncio
+import contextlib
+import random
+import threading
+import time
 
-class Scheduler:
+
+class _Default:
+    '''
+    Class attribute created on first access
+
+    Creating a transport loads the system CA certificates, which is slow,
+    so it is not done on import.
+    '''
+
+    def __init__(self, factory):
+        self._factory = factory
+        self._value = None
+        self._lock = threading.Lock()
+
+    def __get__(self, instance, owner):
+        if self._value is None:
+            with self._lock:
+                if self._value is None:
+                    self._value = self._factory()
+        return self._value
+
+
+class _Inline:
+    '''
+    Stand-in for ThreadPoolExecutor running everything in the calling thread
+    '''
+
+    def map(self, fn, *iterables):
+        return map(fn, *iterables)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+class Backoff:
+    '''
+    Exponential backoff with jitter
+
+    After n failed attempts the next one waits base * factor ** (n - 1)
+    seconds, at most cap, shortened by a random part of up to jitter.
+    '''
+
+    def __init__(self, base: float = 10, factor: float = 2, cap: float = 600, jitter: float = 0.5):
+        if base <= 0 or factor < 1 or cap < base:
+            raise ValueError("invalid backoff")
+        if jitter < 0 or jitter >= 1:
+            raise ValueError("jitter must be in [0, 1)")
+        self.base = base
+        self.factor = factor
+        self.cap = cap
+        self.jitter = jitter
+
+    def delay(self, attempts: int):
+        delay = min(self.cap, self.base * self.factor ** min(attempts - 1, 64))
+        return delay * (1 - self.jitter * random.random())
+
+
+class CircuitBreaker:
+    '''
+    Stops sending to an endpoint after threshold consecutive failures
+
+    While open nothing is sent; after reset seconds a single probe request
+    is let through and its result closes or reopens the breaker.
+    '''
+
+    def __init__(self, threshold: int = 5, reset: float = 30):
+        if threshold < 1:
+            raise ValueError("threshold must be at least 1")
+        self.threshold = threshold
+        self.reset = reset
+        self._failures = 0
+        self._opened = None
+        self._probing = False
+        self._lock = threading.Lock()
+
+    def allow(self):
+        with self._lock:
+            if self._opened is None:
+                return True
+            if self._probing or time.monotonic() - self._opened < self.reset:
+                return False
+            self._probing = True
+            return True
+
+    def success(self):
+        with self._lock:
+            self._failures = 0
+            self._opened = None
+            self._probing = False
+
+    def failure(self):
+        with self._lock:
+            self._failures += 1
+            if self._probing or self._failures >= self.threshold:
+                self._opened = time.monotonic()
+                self._probing = False
+
+    def closed(self):
+        return self._opened is None
+
+
+class Limiter:
+    '''
+    Adaptive limit of requests to the gateway
+
+    At most limit requests run at once. The limit grows by one per limit
+    answered requests faster than target seconds and is multiplied by
+    decrease when a request times out, fails or is slower than target, at
+    most once per target seconds. rate (requests per second, burst at once)
+    caps the request rate on top of that, None means no cap.
+
+    Live invoices always go first: resends by dispatch wait while a live
+    invoice is waiting and use at most backlog_share of the limit. A live
+    invoice waits at most wait seconds, then it is queued unsent.
+    '''
+
+    def __init__(
+        self,
+        initial: int = 4,
+        min_limit: int = 1,
+        max_limit: int = 64,
+        target: float = 1,
+        decrease: float = 0.7,
+        rate: float = None,
+        burst: int = 10,
+        backlog_share: float = 0.5,
+        wait: float = 1
+    ):
+        if min_limit < 1 or max_limit < min_limit or not min_limit <= initial <= max_limit:
+            raise ValueError("invalid limits")
+        if not 0 < decrease < 1:
+            raise ValueError("decrease must be in (0, 1)")
+        if not 0 < backlog_share <= 1:
+            raise ValueError("backlog_share must be in (0, 1]")
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.target = target
+        self.decrease = decrease
+        self.rate = rate
+        self.burst = burst
+        self.backlog_share = backlog_share
+        self.wait = wait
+        self.limit = float(initial)
+        self._inflight = 0
+        self._live_waiting = 0
+        self._tokens = float(burst)
+        self._refilled = time.monotonic()
+        self._decreased = 0.0
+        self._cond = threading.Condition()
+        # event loop: [asyncio.Event set when a slot may be free, coroutines waiting]
+        self._loops = {}
+
+    def acquire(self, live: bool = True, timeout: float = None):
+        '''
+        Wait for a free slot, False if none was free within timeout seconds
+        '''
+        end = None if timeout is None else time.monotonic() + timeout
+        with self._cond:
+            if live:
+                self._live_waiting += 1
+            try:
+                while True:
+                    wait = self._take(live)
+                    if wait is None:
+                        return True
+                    if end is not None:
+                        left = end - time.monotonic()
+                        if left <= 0:
+                            return False
+                        wait = left if wait == 0 else min(wait, left)
+                    elif wait == 0 and self.rate is not None:
+                        # tokens are not signalled, look again when the next one is due
+                        wait = 1 / self.rate
+                    self._cond.wait(wait or None)
+            finally:
+                if live:
+                    self._live_waiting -= 1
+                    # resends may have been waiting for this invoice only
+                    self._wake()
+
+    async def acquire_async(self, live: bool = True, timeout: float = None):
+        '''
+        Same as acquire, for asyncio
+
+        The lock is only held for bookkeeping, waiting is done on an
+        asyncio.Event set from release.
+        '''
+        loop = asyncio.get_event_loop()
+        end = None if timeout is None else loop.time() + timeout
+        with self._cond:
+            if live:
+                self._live_waiting += 1
+            waiting = self._loops.get(loop)
+            if waiting is None:
+                waiting = self._loops[loop] = [asyncio.Event(), 0]
+            waiting[1] += 1
+        event = waiting[0]
+        try:
+            while True:
+                with self._cond:
+                    # a release after this sets it again
+                    event.clear()
+                    wait = self._take(live)
+                if wait is None:
+                    return True
+                if end is not None:
+                    left = end - loop.time()
+                    if left <= 0:
+                        return False
+                    wait = left if wait == 0 else min(wait, left)
+                elif wait == 0 and self.rate is not None:
+                    wait = 1 / self.rate
+                try:
+                    await asyncio.wait_for(event.wait(), wait or None)
+                except asyncio.TimeoutError:
+                    pass
+        finally:
+            with self._cond:
+                waiting[1] -= 1
+                if not waiting[1]:
+                    del self._loops[loop]
+                if live:
+                    self._live_waiting -= 1
+                    self._wake()
+
+    def release(self, latency: float = None, answered: bool = True):
+        '''
+        Free the slot, latency is None if no request was sent
+        '''
+        with self._cond:
+            self._inflight -= 1
+            if latency is not None:
+                now = time.monotonic()
+                if answered and latency <= self.target:
+                    self.limit = min(self.max_limit, self.limit + 1 / self.limit)
+                elif now - self._decreased >= self.target:
+                    self.limit = max(self.min_limit, self.limit * self.decrease)
+                    self._decreased = now
+            self._wake()
+
+    def _wake(self):
+        # with _cond held, threads and event loops look at the slots again
+        self._cond.notify_all()
+        for loop, (event, _) in self._loops.items():
+            try:
+                loop.call_soon_threadsafe(event.set)
+            except RuntimeError:
+                # the loop is closed
+                pass
+
+    def _take(self, live):
+        # None when a slot was taken, else seconds to wait (0 until a slot is released)
+        limit = int(self.limit)
+        if not live:
+            if self._live_waiting:
+                return 0
+            limit = max(1, int(self.limit * self.backlog_share))
+        if self._inflight >= limit:
+            return 0
+        if self.rate is not None:
+            now = time.monotonic()
+            self._tokens = min(self.burst, self._tokens + (now - self._refilled) * self.rate)
+            self._refilled = now
+            if self._tokens < 1:
+                return (1 - self._tokens) / self.rate
+            self._tokens -= 1
+        self._inflight += 1
+        return None
+
+
+def _answered(resp):
+    # the gateway replied, either accepting or rejecting the invoice
+    return bool(resp) or resp.Chyba["kod"] is not None
+
+def _rejected(resp):
+    return resp.rejected()
+
+def _report(metrics, resp):
+    if not resp or resp.Chyba["kod"] is not None:
+        metrics.error(resp.Chyba["kod"])
+    if resp.Varovani["kod_varov"] is not None:
+        metrics.warning(resp.Varovani["kod_varov"])
+
+
+class _Retrying:
+    '''
+    Queue, backoff and circuit breaker bookkeeping shared by the schedulers
+    '''
+
+    def __init__(self, queue, backoff, breaker_threshold, breaker_reset, on_accepted, metrics, store, limiter, on_rejected):
+        self._queue = queue if queue is not None else storage.MemoryQueue()
+        self._backoff = backoff if backoff is not None else Backoff()
+        self._breaker_threshold = breaker_threshold
+        self._breaker_reset = breaker_reset
+        self._on_accepted = on_accepted
+        self._on_rejected = on_rejected
+        self._metrics = metrics
+        self._store = store
+        self._limiter = limiter
+        self._breakers = {}
+        self._lock = threading.Lock()
+
+    def _breaker(self, invoice):
+        endpoint = Scheduler.endpoint(invoice)
+        with self._lock:
+            if endpoint not in self._breakers:
+                self._breakers[endpoint] = CircuitBreaker(self._breaker_threshold, self._breaker_reset)
+            return self._breakers[endpoint]
+
+    def _sink(self, invoice):
+        # metrics of the scheduler, or of the config the invoice was made with
+        return self._metrics if self._metrics is not None else invoice.metrics()
+
+    def _record(self, breaker, resp):
+        if _answered(resp):
+            breaker.success()
+        else:
+            breaker.failure()
+
+    def _enqueue(self, invoice):
+        invoice.Hlavicka["prvni_zaslani"] = types.boolean(False)
+        self._queue.put(invoice, time.time() + self._backoff.delay(1))
+
+    def _answer(self, invoice, resp):
+        if self._store is not None:
+            self._store.record(invoice, resp)
+        if resp and self._on_accepted is not None:
+            self._on_accepted(invoice, resp)
+        elif _rejected(resp) and self._on_rejected is not None:
+            self._on_rejected(invoice, resp)
+
+    def _settle(self, pending, responses):
+        # None means the invoice was not sent in this pass and stays as is
+        self._queue.remove([invoice for invoice, resp in zip(pending, responses) if resp is not None and (resp or _rejected(resp))])
+        self._queue.postpone([invoice for invoice, resp in zip(pending, responses) if resp is not None and not resp and not _rejected(resp)], self._backoff.delay)
+        for invoice, resp in zip(pending, responses):
+            if resp is not None:
+                self._answer(invoice, resp)
+        if pending:
+            self._sink(pending[0]).queue_depth(len(self._queue))
+
+    def _halted(self):
+        with self._lock:
+            return bool(self._breakers) and not any(breaker.closed() for breaker in self._breakers.values())
+
+
+class Scheduler(_Retrying):
 
     PLAYGROUND_ENDPOINT = "https://pg.eet.cz:443/eet/services/EETServiceSOAP/v3/"
     PRODUCTION_ENDPOINT = "https://eet.cz:443/eet/services/EETServiceSOAP/v3/"
 
-    def __init__(self):
-        self._queue = []
+    # shared by every send that does not bring its own transport
+    TRANSPORT = _Default(transport.Transport)
+
+    def __init__(
+        self,
+        transport: transport.Transport = None,
+        concurrency: int = 1,
+        queue=None,
+        backoff: Backoff = None,
+        breaker_threshold: int = 5,
+        breaker_reset: float = 30,
+        on_accepted=None,
+        metrics: monitoring.Metrics = None,
+        store: storage.FikStore = None,
+        limiter: Limiter = None,
+        on_rejected=None
+    ):
+        if concurrency < 1:
+            raise ValueError("concurrency must be at least 1")
+        super().__init__(queue, backoff, breaker_threshold, breaker_reset, on_accepted, metrics, store, limiter, on_rejected)
+        self._transport = transport
+        self._concurrency = concurrency
 
     def process(self, invoice):
-        resp = self.send(invoice)
-        if not resp:
-            invoice.Hlavicka["prvni_zaslani"] = types.boolean(False)
-            self._queue.append(invoice)
+        try:
+            resp = self._attempt(invoice, True)
+        except Exception:
+            # the codes may be printed already, the invoice must be resent
+            self._enqueue(invoice)
+            raise
+        if resp is None:
+            # gateway is down or busy, do not make the customer wait for a timeout;
+            # only the codes are needed, the envelope is built when it is resent
+            invoice.sign()
+            resp = invoices.Factory.Response(invoice.codes(), binding.Odpoved())
+        if not resp and not _rejected(resp):
+            self._enqueue(invoice)
+        self._answer(invoice, resp)
         return resp
+
+    def _attempt(self, invoice, live, timeout=None):
+        '''
+        Send invoice if the limiter and circuit breaker let it, else None
+        '''
+        limiter = self._limiter
+        if limiter is not None and not limiter.acquire(live, limiter.wait if live else timeout):
+            return None
+        latency = None
+        answered = False
+        try:
+            breaker = self._breaker(invoice)
+            if not breaker.allow():
+                return None
+            if not live:
+                self._sink(invoice).retry()
+            start = time.monotonic()
+            try:
+                resp = self.send(invoice, self._transport, self._metrics)
+            except Exception as e:
+                # e.g. a response failing validation, never leave a probe open
+                breaker.failure()
+                self._sink(invoice).exception(e)
+                raise
+            latency = time.monotonic() - start
+            answered = _answered(resp)
+            self._record(breaker, resp)
+            return resp
+        finally:
+            if limiter is not None:
+                limiter.release(latency, answered)
     
-    def dispatch(self):
-        queue = []
-        for invoice in self._queue:
-            resp = self.send(invoice)
-            if not resp:
-                queue.append(invoice)
-        self._queue = queue
+    def dispatch(self, deadline: float = None):
+        '''
+        Resend queued invoices that are due, at most `concurrency` at once
+
+        Failed invoices are postponed by the backoff, invoices rejected with
+        a positive error code are dropped (see on_rejected). Invoices not started
+        within `deadline` seconds, or while the circuit breaker of their
+        endpoint is open, stay queued for the next pass. Keep the transport
+        pool at least as large as concurrency.
+        '''
+        end = None if deadline is None else time.monotonic() + deadline
+
+        def resend(invoice):
+            if end is None:
+                return self._attempt(invoice, False)
+            left = end - time.monotonic()
+            if left <= 0:
+                return None
+            return self._attempt(invoice, False, left)
+
+        with ThreadPoolExecutor(self._concurrency) if self._concurrency > 1 else _Inline() as pool:
+            with contextlib.closing(self._queue.pending(time.time())) as chunks:
+                for pending in chunks:
+                    responses = [None] * len(pending)
+                    try:
+                        for i, resp in enumerate(pool.map(resend, pending)):
+                            responses[i] = resp
+                    finally:
+                        # whatever was not accepted stays queued, even if a send raised
+                        self._settle(pending, responses)
+                    if end is not None and time.monotonic() >= end or self._halted():
+                        break
+
+    @staticmethod
+    def endpoint(invoice):
+        return Scheduler.PRODUCTION_ENDPOINT if invoice.prod() else Scheduler.PLAYGROUND_ENDPOINT
 
     @staticmethod
-    def send(invoice):
+    def send(invoice, transport: transport.Transport = None, metrics: monitoring.Metrics = None):
+        metrics = metrics if metrics is not None else invoice.metrics()
         xml = invoice.build()
-        endpoint = Scheduler.PRODUCTION_ENDPOINT if invoice.prod() else Scheduler.PLAYGROUND_ENDPOINT
+        endpoint = Scheduler.endpoint(invoice)
 
         try:
-            resp = Scheduler._request(endpoint, xml)
-            resp_data = binding.Soap.parse_response(resp, not invoice.prod())
-            return invoices.Factory.Response(invoice.codes(), resp_data)
+            with metrics.timer("request"):
+                resp = Scheduler._request(endpoint, xml, transport)
+            with metrics.timer("parse"):
+                resp_data = binding.Soap.parse_response(resp, not invoice.prod())
+            resp = invoices.Factory.Response(invoice.codes(), resp_data)
         except error.URLError:
-            return invoices.Factory.Response(invoice.codes(), binding.Odpoved())
+            resp = invoices.Factory.Response(invoice.codes(), binding.Odpoved())
+        _report(metrics, resp)
+        return resp
     
     @staticmethod
-    def _request(endpoint, data):
-        req = request.Request(endpoint, data, method="POST")
-        with request.urlopen(req, timeout=3) as response:
-            return response.read()
-        
\ No newline at end of file
+    def _request(endpoint, data, transport: transport.Transport = None):
+        return (transport or Scheduler.TRANSPORT).request(endpoint, data)
+
+
+class AsyncScheduler(_Retrying):
+    '''
+    asyncio counterpart of Scheduler
+
+    Signing and response validation are CPU bound, they run in executor
+    (default executor of the loop if None) so the event loop stays free.
+    '''
+
+    # shared by every send that does not bring its own transport
+    TRANSPORT = _Default(transport.AsyncTransport)
+
+    def __init__(
+        self,
+        transport: transport.AsyncTransport = None,
+        executor=None,
+        concurrency: int = 100,
+        queue=None,
+        backoff: Backoff = None,
+        breaker_threshold: int = 5,
+        breaker_reset: float = 30,
+        on_accepted=None,
+        metrics: monitoring.Metrics = None,
+        store: storage.FikStore = None,
+        limiter: Limiter = None,
+        on_rejected=None
+    ):
+        if concurrency < 1:
+            raise ValueError("concurrency must be at least 1")
+        super().__init__(queue, backoff, breaker_threshold, breaker_reset, on_accepted, metrics, store, limiter, on_rejected)
+        self._transport = transport
+        self._executor = executor
+        self._concurrency = concurrency
+
+    async def process(self, invoice):
+        try:
+            resp = await self._attempt(invoice, True)
+        except Exception:
+            self._enqueue(invoice)
+            raise
+        if resp is None:
+            await asyncio.get_event_loop().run_in_executor(self._executor, invoice.sign)
+            resp = invoices.Factory.Response(invoice.codes(), binding.Odpoved())
+        if not resp and not _rejected(resp):
+            self._enqueue(invoice)
+        self._answer(invoice, resp)
+        return resp
+
+    async def _attempt(self, invoice, live, timeout=None):
+        '''
+        Same as Scheduler._attempt
+        '''
+        limiter = self._limiter
+        if limiter is not None and not await limiter.acquire_async(live, limiter.wait if live else timeout):
+            return None
+        latency = None
+        answered = False
+        try:
+            breaker = self._breaker(invoice)
+            if not breaker.allow():
+                return None
+            if not live:
+                self._sink(invoice).retry()
+            loop = asyncio.get_event_loop()
+            start = loop.time()
+            try:
+                resp = await self.send(invoice, self._transport, self._executor, self._metrics)
+            except Exception as e:
+                breaker.failure()
+                self._sink(invoice).exception(e)
+                raise
+            latency = loop.time() - start
+            answered = _answered(resp)
+            self._record(breaker, resp)
+            return resp
+        finally:
+            if limiter is not None:
+                limiter.release(latency, answered)
+
+    async def dispatch(self, deadline: float = None):
+        '''
+        Same as Scheduler.dispatch
+        '''
+        loop = asyncio.get_event_loop()
+        end = None if deadline is None else loop.time() + deadline
+        slots = asyncio.Semaphore(self._concurrency)
+
+        async def resend(invoice):
+            async with slots:
+                if end is None:
+                    return await self._attempt(invoice, False)
+                left = end - loop.time()
+                if left <= 0:
+                    return None
+                return await self._attempt(invoice, False, left)
+
+        with contextlib.closing(self._queue.pending(time.time())) as chunks:
+            for pending in chunks:
+                responses = await asyncio.gather(*[resend(invoice) for invoice in pending], return_exceptions=True)
+                # exceptions, CancelledError included, leave the invoice queued
+                self._settle(pending, [resp if isinstance(resp, invoices.Factory.Response) else None for resp in responses])
+                for resp in responses:
+                    if isinstance(resp, BaseException):
+                        raise resp
+                if end is not None and loop.time() >= end or self._halted():
+                    break
+
+    @staticmethod
+    async def send(invoice, transport: transport.AsyncTransport = None, executor=None, metrics: monitoring.Metrics = None):
+        metrics = metrics if metrics is not None else invoice.metrics()
+        loop = asyncio.get_event_loop()
+        xml = await loop.run_in_executor(executor, invoice.build)
+        endpoint = Scheduler.endpoint(invoice)
+
+        try:
+            with metrics.timer("request"):
+                resp = await (transport or AsyncScheduler.TRANSPORT).request(endpoint, xml)
+            with metrics.timer("parse"):
+                resp_data = await loop.run_in_executor(executor, binding.Soap.parse_response, resp, not invoice.prod())
+            resp = invoices.Factory.Response(invoice.codes(), resp_data)
+        except error.URLError:
+            resp = invoices.Factory.Response(invoice.codes(), binding.Odpoved())
+        _report(metrics, resp)
+        return resp
+
+
+class Sender:
+    '''
+    Sends invoices from background threads
+
+    submit() computes PKP/BKP in the calling thread, so the receipt can be
+    printed at once, and returns a Future resolved with the Response that
+    carries the FIK - after retries by dispatch if the first attempt fails
+    or raises.
+    An invoice the gateway rejects for good resolves it with the rejection
+    (a false Response with Chyba). Keyword arguments are passed to Scheduler.
+    '''
+
+    def __init__(self, workers: int = 1, interval: float = 60, **kwargs):
+        self._user_accepted = kwargs.pop("on_accepted", None)
+        self._user_rejected = kwargs.pop("on_rejected", None)
+        self._scheduler = Scheduler(on_accepted=self._resolve, on_rejected=self._resolve, **kwargs)
+        self._pool = ThreadPoolExecutor(workers)
+        self._futures = {}
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._dispatcher = threading.Thread(target=self._dispatch, args=(interval,), daemon=True)
+        self._dispatcher.start()
+
+    def submit(self, invoice):
+        invoice.sign()
+        future = Future()
+        with self._lock:
+            self._futures.setdefault(invoice.codes().bkp, []).append(future)
+        self._pool.submit(self._process, invoice, future)
+        return future
+
+    def close(self, wait: bool = True):
+        '''
+        Stop sending, invoices not accepted yet stay in the scheduler queue
+        '''
+        self._stop.set()
+        self._pool.shutdown(wait)
+        if wait:
+            self._dispatcher.join()
+
+    def _process(self, invoice, future):
+        try:
+            self._scheduler.process(invoice)
+        except Exception:
+            # process queued the invoice and reported the error to metrics,
+            # the future is resolved once dispatch gets an answer
+            pass
+
+    def _dispatch(self, interval):
+        while not self._stop.wait(interval):
+            try:
+                self._scheduler.dispatch()
+            except Exception as e:
+                # invoices stay queued, try again in the next pass
+                if self._scheduler._metrics is not None:
+                    self._scheduler._metrics.exception(e)
+
+    def _resolve(self, invoice, resp):
+        with self._lock:
+            futures = self._futures.pop(invoice.codes().bkp, [])
+        for future in futures:
+            future.set_result(resp)
+        callback = self._user_accepted if resp else self._user_rejected
+        if callback is not None:
+            callback(invoice, resp)
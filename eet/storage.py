@@ -0,0 +1,411 @@
+from . import invoices, records, types
+
+from datetime import datetime
+from decimal import Decimal
+
+import heapq
+import itertools
+import json
+import sqlite3
+import threading
+import time
+
+'''
+Retry queues used by remote.Scheduler and the store of sent invoices
+'''
+
+_DATETIME = "%Y-%m-%dT%H:%M:%S.%f"
+
+def _dump_value(val):
+    if isinstance(val, types.boolean):
+        return bool(val)
+    if isinstance(val, datetime):
+        # dateTime is formatted from its wall time only
+        return val.strftime(_DATETIME)
+    if isinstance(val, int):
+        return int(val)
+    # amounts are kept as text so they do not go through float
+    return str(val)
+
+def _load_castka(val):
+    # queues written before amounts were Decimal hold floats
+    return types.CastkaType(Decimal(val) if isinstance(val, str) else val)
+
+def _load_datetime(val):
+    date = datetime.strptime(val, _DATETIME)
+    return types.dateTime(date.year, date.month, date.day, date.hour, date.minute, date.second, date.microsecond)
+
+_FIELDS = {
+    "uuid_zpravy": types.UUIDType,
+    "dat_odesl": _load_datetime,
+    "prvni_zaslani": types.boolean,
+    "overeni": types.boolean,
+    "dic_popl": types.CZDICType,
+    "dic_poverujiciho": types.CZDICType,
+    "id_provoz": types.IdProvozType,
+    "id_pokl": types.string20,
+    "porad_cis": types.string25,
+    "dat_trzby": _load_datetime,
+    "rezim": types.RezimType
+}
+
+def dump(invoice):
+    '''
+    Serialize signed invoice to JSON text
+    '''
+    return json.dumps({
+        "hlavicka": {k: _dump_value(v) for k, v in invoice.Hlavicka.items() if v is not None},
+        "data": {k: _dump_value(v) for k, v in invoice.Data.items() if v is not None},
+        "pkp": invoice.codes().pkp,
+        "bkp": invoice.codes().bkp
+    }, separators=(",", ":"))
+
+def load(config, text):
+    '''
+    Restore invoice serialized by dump
+    '''
+    obj = json.loads(text)
+    invoice = invoices.Factory.Invoice(config)
+    for k, v in obj["hlavicka"].items():
+        invoice.Hlavicka[k] = _FIELDS[k](v)
+    for k, v in obj["data"].items():
+        invoice.Data[k] = _FIELDS.get(k, _load_castka)(v)
+    invoice._restore(types.PkpType(obj["pkp"]), types.BkpType(obj["bkp"]))
+    return invoice
+
+
+class MemoryQueue:
+    '''
+    In-memory retry queue ordered by next attempt, lost when the process exits
+    '''
+
+    def __init__(self):
+        # heap of [due, seq, invoice, attempts]
+        self._heap = []
+        self._taken = {}
+        self._seq = itertools.count()
+        self._lock = threading.Lock()
+
+    def put(self, invoice, due: float = 0):
+        with self._lock:
+            heapq.heappush(self._heap, [due, next(self._seq), invoice, 1])
+
+    def pending(self, now: float = None, size: int = 1000):
+        '''
+        Invoices due at now, soonest first, in lists of at most size
+
+        Each yielded invoice should be passed to remove or postpone, the
+        rest is put back unchanged when the generator is closed.
+        '''
+        now = time.time() if now is None else now
+        try:
+            while True:
+                with self._lock:
+                    chunk = []
+                    while self._heap and self._heap[0][0] <= now and len(chunk) < size:
+                        entry = heapq.heappop(self._heap)
+                        self._taken[id(entry[2])] = entry
+                        chunk.append(entry[2])
+                if not chunk:
+                    return
+                yield chunk
+        finally:
+            with self._lock:
+                for entry in self._taken.values():
+                    heapq.heappush(self._heap, entry)
+                self._taken = {}
+
+    def remove(self, done):
+        with self._lock:
+            for invoice in done:
+                self._taken.pop(id(invoice), None)
+
+    def postpone(self, failed, delay):
+        '''
+        Count another failed attempt and wait delay(attempts) seconds
+        '''
+        now = time.time()
+        with self._lock:
+            for invoice in failed:
+                entry = self._taken.pop(id(invoice), None)
+                if entry is not None:
+                    heapq.heappush(self._heap, [now + delay(entry[3] + 1), next(self._seq), invoice, entry[3] + 1])
+
+    def flush(self):
+        pass
+
+    def close(self):
+        pass
+
+    def __len__(self):
+        return len(self._heap) + len(self._taken)
+
+
+class SqliteQueue:
+    '''
+    Durable retry queue in an SQLite database (WAL mode)
+
+    Invoices are stored signed, with their PKP/BKP, and restored using
+    config when the queue is read. Puts are committed in groups of batch
+    (call flush to commit earlier); WAL with synchronous=NORMAL survives
+    process crashes and leaves fsync to checkpoints.
+    '''
+
+    def __init__(self, path, config, batch: int = 1):
+        if batch < 1:
+            raise ValueError("batch must be at least 1")
+        self._config = config
+        self._batch = batch
+        self._uncommitted = 0
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(str(path), check_same_thread=False, isolation_level=None)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS queue ("
+            "id INTEGER PRIMARY KEY, bkp TEXT UNIQUE NOT NULL, invoice TEXT NOT NULL, "
+            "due REAL NOT NULL DEFAULT 0, attempts INTEGER NOT NULL DEFAULT 1)"
+        )
+        self._db.execute("CREATE INDEX IF NOT EXISTS queue_due ON queue (due, id)")
+
+    def put(self, invoice, due: float = 0):
+        text = dump(invoice)
+        with self._lock:
+            if not self._uncommitted:
+                self._db.execute("BEGIN")
+            self._db.execute("INSERT OR REPLACE INTO queue (bkp, invoice, due) VALUES (?, ?, ?)", (invoice.codes().bkp, text, due))
+            self._uncommitted += 1
+            if self._uncommitted >= self._batch:
+                self._commit()
+
+    def pending(self, now: float = None, size: int = 1000):
+        '''
+        Invoices due at now, soonest first, in lists of at most size
+
+        Only one list is held in memory at a time.
+        '''
+        now = time.time() if now is None else now
+        with self._lock:
+            self._commit()
+        last = (-1, 0)
+        while True:
+            with self._lock:
+                rows = self._db.execute(
+                    "SELECT due, id, invoice FROM queue WHERE due <= ? AND (due > ? OR (due = ? AND id > ?)) ORDER BY due, id LIMIT ?",
+                    (now, last[0], last[0], last[1], size)
+                ).fetchall()
+            if not rows:
+                return
+            last = rows[-1][:2]
+            yield [load(self._config, text) for _, _, text in rows]
+
+    def remove(self, done):
+        with self._lock:
+            self._commit()
+            with self._db:
+                self._db.execute("BEGIN")
+                self._db.executemany("DELETE FROM queue WHERE bkp = ?", [(invoice.codes().bkp,) for invoice in done])
+
+    def postpone(self, failed, delay):
+        '''
+        Count another failed attempt and wait delay(attempts) seconds
+        '''
+        now = time.time()
+        with self._lock:
+            self._commit()
+            with self._db:
+                self._db.execute("BEGIN")
+                for invoice in failed:
+                    row = self._db.execute("SELECT attempts FROM queue WHERE bkp = ?", (invoice.codes().bkp,)).fetchone()
+                    if row is not None:
+                        self._db.execute(
+                            "UPDATE queue SET due = ?, attempts = ? WHERE bkp = ?",
+                            (now + delay(row[0] + 1), row[0] + 1, invoice.codes().bkp)
+                        )
+
+    def flush(self):
+        with self._lock:
+            self._commit()
+
+    def close(self):
+        self.flush()
+        self._db.close()
+
+    def _commit(self):
+        if self._uncommitted:
+            self._db.execute("COMMIT")
+            self._uncommitted = 0
+
+    def __len__(self):
+        with self._lock:
+            return self._db.execute("SELECT COUNT(*) FROM queue").fetchone()[0]
+
+
+class Receipt(records.Record):
+    __slots__ = (
+        "bkp", # types.BkpType
+        "pkp", # types.PkpType
+        "porad_cis", # types.string25
+        "dat_trzby", # types.dateTime
+        "uuid_zpravy", # types.UUIDType of the last attempt
+        "fik", # Optional[types.FikType]
+        "status", # "accepted", "rejected" or "pending"
+        "kod" # Optional[types.KodChybaType]
+    )
+
+
+class FikStore:
+    '''
+    Index of sent invoices and their FIK in an SQLite database
+
+    Pass it as store to a scheduler, every answer (or its absence) is then
+    recorded. A background thread writes the records in one transaction
+    once batch of them are waiting, or interval seconds after the last
+    write; lookups flush first, so they always see everything recorded.
+    '''
+
+    _COLUMNS = "bkp, pkp, porad_cis, dat_trzby, uuid_zpravy, fik, status, kod"
+
+    def __init__(self, path, batch: int = 100, interval: float = 1):
+        if batch < 1:
+            raise ValueError("batch must be at least 1")
+        self._batch = batch
+        self._interval = interval
+        self._buffer = {}
+        # _lock guards the buffer, _db_lock the connection; records only wait for the first
+        self._lock = threading.Lock()
+        self._db_lock = threading.Lock()
+        self._wake = threading.Event()
+        self._closed = False
+        self._db = sqlite3.connect(str(path), check_same_thread=False, isolation_level=None)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS receipts ("
+            "bkp TEXT PRIMARY KEY, pkp TEXT NOT NULL, porad_cis TEXT NOT NULL, dat_trzby TEXT NOT NULL, "
+            "uuid_zpravy TEXT, fik TEXT, status TEXT NOT NULL, kod INTEGER)"
+        )
+        self._db.execute("CREATE INDEX IF NOT EXISTS receipts_uuid ON receipts (uuid_zpravy)")
+        self._db.execute("CREATE INDEX IF NOT EXISTS receipts_dat_trzby ON receipts (dat_trzby)")
+        self._db.execute("CREATE INDEX IF NOT EXISTS receipts_porad_cis ON receipts (porad_cis)")
+        self._writer = threading.Thread(target=self._run, daemon=True)
+        self._writer.start()
+
+    def record(self, invoice, resp=None):
+        '''
+        Remember invoice with its response, pending if there is none yet
+        '''
+        if resp:
+            status = "accepted"
+        elif resp is not None and resp.rejected():
+            status = "rejected"
+        else:
+            # no answer or a temporary error, the invoice is sent again
+            status = "pending"
+        codes = invoice.codes()
+        row = (
+            str(codes.bkp),
+            str(codes.pkp),
+            str(invoice.Data["porad_cis"]),
+            _dump_value(invoice.Data["dat_trzby"]),
+            _optional(invoice.Hlavicka["uuid_zpravy"]),
+            _optional(codes.fik if resp else None),
+            status,
+            None if resp is None or resp.Chyba["kod"] is None else int(resp.Chyba["kod"])
+        )
+        with self._lock:
+            self._buffer[row[0]] = row
+            full = len(self._buffer) >= self._batch
+        if full:
+            self._wake.set()
+
+    def get(self, bkp):
+        return self._one("bkp = ?", (str(bkp),))
+
+    def by_uuid(self, uuid_zpravy):
+        return self._one("uuid_zpravy = ?", (str(uuid_zpravy),))
+
+    def by_porad_cis(self, porad_cis):
+        return self._many("porad_cis = ? ORDER BY dat_trzby", (str(porad_cis),))
+
+    def between(self, start: datetime, end: datetime, status: str = None):
+        '''
+        Invoices with start <= dat_trzby < end, optionally only of status
+        '''
+        if status is None:
+            return self._many("dat_trzby >= ? AND dat_trzby < ? ORDER BY dat_trzby", (_dump_value(start), _dump_value(end)))
+        return self._many(
+            "dat_trzby >= ? AND dat_trzby < ? AND status = ? ORDER BY dat_trzby",
+            (_dump_value(start), _dump_value(end), status)
+        )
+
+    def flush(self):
+        with self._db_lock:
+            self._write()
+
+    def close(self):
+        self._closed = True
+        self._wake.set()
+        self._writer.join()
+        with self._db_lock:
+            self._write()
+            self._db.close()
+
+    def _run(self):
+        while not self._closed:
+            self._wake.wait(self._interval)
+            self._wake.clear()
+            try:
+                self.flush()
+            except sqlite3.Error:
+                # rows are back in the buffer, try again on the next wake up
+                pass
+
+    def _write(self):
+        # with _db_lock held
+        with self._lock:
+            rows, self._buffer = list(self._buffer.values()), {}
+        if not rows:
+            return
+        try:
+            with self._db:
+                self._db.execute("BEGIN")
+                self._db.executemany("INSERT OR REPLACE INTO receipts (" + self._COLUMNS + ") VALUES (?, ?, ?, ?, ?, ?, ?, ?)", rows)
+        except sqlite3.Error:
+            with self._lock:
+                for row in rows:
+                    # a newer record of the same invoice wins
+                    self._buffer.setdefault(row[0], row)
+            raise
+
+    def _one(self, where, args):
+        found = self._many(where, args)
+        return found[0] if found else None
+
+    def _many(self, where, args):
+        with self._db_lock:
+            self._write()
+            rows = self._db.execute("SELECT " + self._COLUMNS + " FROM receipts WHERE " + where, args).fetchall()
+        return [_receipt(row) for row in rows]
+
+    def __len__(self):
+        with self._db_lock:
+            self._write()
+            return self._db.execute("SELECT COUNT(*) FROM receipts").fetchone()[0]
+
+
+def _optional(val):
+    return None if val is None else str(val)
+
+def _receipt(row):
+    bkp, pkp, porad_cis, dat_trzby, uuid_zpravy, fik, status, kod = row
+    return Receipt(
+        bkp=types.BkpType(bkp),
+        pkp=types.PkpType(pkp),
+        porad_cis=types.string25(porad_cis),
+        dat_trzby=_load_datetime(dat_trzby),
+        uuid_zpravy=None if uuid_zpravy is None else types.UUIDType(uuid_zpravy),
+        fik=None if fik is None else types.FikType(fik),
+        status=status,
+        kod=None if kod is None else types.KodChybaType(kod)
+    )
@@ -0,0 +1,316 @@
+from http import client
+from urllib import error, parse
+
+import asyncio
+import base64
+import ssl
+import threading
+
+'''
+HTTP transports used by remote.Scheduler and remote.AsyncScheduler to talk
+to the EET gateway
+'''
+
+# errors of a keep-alive connection the server has already closed
+_STALE = (client.RemoteDisconnected, ConnectionResetError, BrokenPipeError, ssl.SSLEOFError, ssl.SSLZeroReturnError)
+
+class _Connection(client.HTTPSConnection):
+    '''
+    HTTPS connection that resumes the last TLS session of its pool and
+    uses separate connect and read timeouts
+    '''
+
+    def __init__(self, host, port, context, connect_timeout, read_timeout, session=None, proxy=None):
+        if proxy is not None:
+            # CONNECT tunnel through (host, port, headers) of an HTTP proxy
+            super().__init__(proxy[0], proxy[1], timeout=connect_timeout, context=context)
+            self.set_tunnel(host, port, proxy[2])
+        else:
+            super().__init__(host, port, timeout=connect_timeout, context=context)
+        self._ssl_context = context
+        self._read_timeout = read_timeout
+        self.session = session
+
+    def connect(self):
+        client.HTTPConnection.connect(self)
+        server_hostname = self._tunnel_host or self.host
+        self.sock = self._ssl_context.wrap_socket(self.sock, server_hostname=server_hostname, session=self.session)
+        self.sock.settimeout(self._read_timeout)
+        self.session = self.sock.session
+
+
+class _Pool:
+    '''
+    Idle keep-alive connections to a single endpoint
+    '''
+
+    def __init__(self, host, port, size, proxy=None):
+        self.host = host
+        self.port = port
+        self.proxy = proxy
+        self.session = None
+        self._idle = []
+        self._lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(size)
+
+    def acquire(self, timeout):
+        if not self._slots.acquire(timeout=timeout):
+            raise error.URLError("connection pool exhausted")
+        with self._lock:
+            if self._idle:
+                return self._idle.pop()
+        return None
+
+    def release(self, conn):
+        with self._lock:
+            if conn is not None and conn.sock is not None:
+                self._idle.append(conn)
+        self._slots.release()
+
+    def clear(self):
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for conn in idle:
+            conn.close()
+
+
+class Transport:
+    '''
+    Blocking HTTP/1.1 transport with a keep-alive connection pool per endpoint
+
+    pool_size       -- maximum number of connections open to one endpoint
+    connect_timeout -- seconds to wait for TCP connect and TLS handshake
+    read_timeout    -- seconds to wait for the response
+    context         -- ssl.SSLContext, defaults to ssl.create_default_context()
+    proxies         -- {"https": url, "no": hosts}, defaults to urllib.request.getproxies()
+                       (HTTPS_PROXY and NO_PROXY), {} connects directly
+    '''
+
+    def __init__(self, pool_size=4, connect_timeout=3, read_timeout=3, context=None, proxies=None):
+        if pool_size < 1:
+            raise ValueError("pool_size must be at least 1")
+        if proxies is None:
+            from urllib import request
+            proxies = request.getproxies()
+        self.pool_size = pool_size
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.context = context if context is not None else ssl.create_default_context()
+        self.proxies = proxies
+        self._pools = {}
+        self._lock = threading.Lock()
+
+    def _proxy(self, host):
+        proxy = self.proxies.get("https")
+        if not proxy:
+            return None
+        from urllib import request
+        if request.proxy_bypass_environment(host, self.proxies):
+            return None
+        url = parse.urlsplit(proxy if "://" in proxy else "http://" + proxy)
+        headers = {}
+        if url.username is not None:
+            credentials = "{0}:{1}".format(parse.unquote(url.username), parse.unquote(url.password or ""))
+            headers["Proxy-Authorization"] = "Basic " + base64.b64encode(credentials.encode()).decode("ascii")
+        return url.hostname, url.port or 8080, headers
+
+    def _pool(self, endpoint):
+        url = parse.urlsplit(endpoint)
+        if url.scheme != "https":
+            raise ValueError("endpoint must use https")
+        key = (url.hostname, url.port or 443)
+        with self._lock:
+            if key not in self._pools:
+                self._pools[key] = _Pool(key[0], key[1], self.pool_size, self._proxy(key[0]))
+            return self._pools[key], url.path or "/"
+
+    def request(self, endpoint, data):
+        pool, path = self._pool(endpoint)
+        conn = pool.acquire(self.connect_timeout)
+        try:
+            # a pooled connection may have been closed by the server meanwhile,
+            # in that case retry once on a fresh one
+            if conn is not None:
+                try:
+                    return self._send(pool, conn, path, data)
+                except _STALE:
+                    conn.close()
+            conn = _Connection(pool.host, pool.port, self.context, self.connect_timeout, self.read_timeout, pool.session, pool.proxy)
+            return self._send(pool, conn, path, data)
+        except (OSError, client.HTTPException) as e:
+            conn.close()
+            conn = None
+            if isinstance(e, error.URLError):
+                raise
+            raise error.URLError(e)
+        finally:
+            pool.release(conn)
+
+    def _send(self, pool, conn, path, data):
+        conn.request("POST", path, data, {"Content-Type": "text/xml; charset=utf-8"})
+        response = conn.getresponse()
+        body = response.read()
+        # TLS 1.3 tickets arrive after the handshake, pick up the latest one
+        if conn.sock is not None:
+            pool.session = conn.session = conn.sock.session
+
+        if response.will_close:
+            conn.close()
+        if response.status >= 400:
+            raise error.HTTPError((conn._tunnel_host or conn.host) + path, response.status, response.reason, response.headers, None)
+        return body
+
+    def close(self):
+        with self._lock:
+            pools = list(self._pools.values())
+        for pool in pools:
+            pool.clear()
+
+
+class _AsyncPool:
+    '''
+    Idle keep-alive streams to a single endpoint
+    '''
+
+    def __init__(self, host, port, size):
+        self.host = host
+        self.port = port
+        self.size = size
+        self._idle = []
+        self._slots = None
+        self._loop = None
+
+    async def acquire(self):
+        # streams and the semaphore belong to one loop, a shared transport
+        # used from a new loop (e.g. the next asyncio.run) starts over
+        loop = asyncio.get_event_loop()
+        if loop is not self._loop:
+            self.clear()
+            self._loop = loop
+            self._slots = asyncio.Semaphore(self.size)
+        await self._slots.acquire()
+        if self._idle:
+            return self._idle.pop()
+        return None
+
+    def release(self, conn):
+        if conn is not None and not conn[1].transport.is_closing():
+            self._idle.append(conn)
+        self._slots.release()
+
+    def clear(self):
+        idle, self._idle = self._idle, []
+        for _, writer in idle:
+            try:
+                writer.close()
+            except RuntimeError:
+                # its loop is closed already
+                pass
+
+
+class AsyncTransport:
+    '''
+    asyncio HTTP/1.1 transport with a keep-alive connection pool per endpoint
+
+    Takes the same arguments as Transport except proxies, it always
+    connects directly. Requests wait for a free connection instead of
+    failing when the pool is exhausted. It can be used from one event loop
+    at a time; idle connections of a previous loop are dropped.
+    '''
+
+    def __init__(self, pool_size=4, connect_timeout=3, read_timeout=3, context=None):
+        if pool_size < 1:
+            raise ValueError("pool_size must be at least 1")
+        self.pool_size = pool_size
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.context = context if context is not None else ssl.create_default_context()
+        self._pools = {}
+
+    def _pool(self, endpoint):
+        url = parse.urlsplit(endpoint)
+        if url.scheme != "https":
+            raise ValueError("endpoint must use https")
+        key = (url.hostname, url.port or 443)
+        if key not in self._pools:
+            self._pools[key] = _AsyncPool(key[0], key[1], self.pool_size)
+        return self._pools[key], url.path or "/"
+
+    async def request(self, endpoint, data):
+        pool, path = self._pool(endpoint)
+        conn = await pool.acquire()
+        try:
+            # same stale connection handling as Transport.request
+            if conn is not None:
+                try:
+                    return await self._send(pool, conn, path, data)
+                except _STALE:
+                    conn[1].close()
+            conn = await asyncio.wait_for(
+                asyncio.open_connection(pool.host, pool.port, ssl=self.context),
+                self.connect_timeout
+            )
+            return await self._send(pool, conn, path, data)
+        except (OSError, asyncio.TimeoutError, asyncio.IncompleteReadError, client.HTTPException, ValueError) as e:
+            if conn is not None:
+                conn[1].close()
+            conn = None
+            if isinstance(e, error.URLError):
+                raise
+            raise error.URLError(e)
+        finally:
+            pool.release(conn)
+
+    async def _send(self, pool, conn, path, data):
+        reader, writer = conn
+        host = pool.host if pool.port == 443 else "{0}:{1}".format(pool.host, pool.port)
+        writer.write((
+            "POST {0} HTTP/1.1\r\n"
+            "Host: {1}\r\n"
+            "Content-Type: text/xml; charset=utf-8\r\n"
+            "Content-Length: {2}\r\n"
+            "\r\n"
+        ).format(path, host, len(data)).encode("latin-1") + data)
+        await writer.drain()
+
+        status, reason, headers, body = await asyncio.wait_for(self._read(reader), self.read_timeout)
+        if headers.get("connection", "").lower() == "close":
+            writer.close()
+        if status >= 400:
+            raise error.HTTPError("https://" + host + path, status, reason, headers, None)
+        return body
+
+    @staticmethod
+    async def _read(reader):
+        line = await reader.readline()
+        if not line:
+            raise client.RemoteDisconnected("remote end closed connection without response")
+        _, status, reason = (line.decode("latin-1").rstrip("\r\n").split(" ", 2) + [""])[:3]
+
+        headers = {}
+        while True:
+            line = await reader.readline()
+            if line in (b"\r\n", b"\n", b""):
+                break
+            name, _, value = line.decode("latin-1").partition(":")
+            headers[name.strip().lower()] = value.strip()
+
+        if headers.get("transfer-encoding", "").lower() == "chunked":
+            body = b""
+            while True:
+                size = int((await reader.readline()).split(b";")[0], 16)
+                if size == 0:
+                    await reader.readline()
+                    break
+                body += await reader.readexactly(size)
+                await reader.readline()
+        elif "content-length" in headers:
+            body = await reader.readexactly(int(headers["content-length"]))
+        else:
+            body = await reader.read()
+            headers["connection"] = "close"
+        return int(status), reason, headers, body
+
+    def close(self):
+        for pool in self._pools.values():
+            pool.clear()
@@ -1,18 +1,26 @@
 from datetime import datetime, timezone
+from decimal import Decimal, ROUND_HALF_UP
 import re
 
 '''
 All types specified in http://fs.mfcr.cz/eet/schema/v3
+
+Instances are validated on creation, so passing an instance of the same
+type returns it unchanged without validating again.
 '''
 
-def _pattern(string: str, regex: str):
-    pattern = re.compile(regex)
-    return pattern.match(string)
+def _pattern(string: str, regex):
+    # regex is compiled once in the class body
+    return regex.match(string)
+
+_WHITESPACE = re.compile(r"\s+")
 
 class UUIDType(str):
-    PATTERN = r"^[0-9a-fA-F]{8}-[0-9a-fA-F]{4}-[1-5][0-9a-fA-F]{3}-[89abAB][0-9a-fA-F]{3}-[0-9a-fA-F]{12}$"
+    PATTERN = re.compile(r"^[0-9a-fA-F]{8}-[0-9a-fA-F]{4}-[1-5][0-9a-fA-F]{3}-[89abAB][0-9a-fA-F]{3}-[0-9a-fA-F]{12}$")
 
     def __new__(cls, val):
+        if type(val) is cls:
+            return val
         if not isinstance(val, str):
             raise ValueError(str(val) + " is not string")
         if not _pattern(val, cls.PATTERN):
@@ -32,7 +40,8 @@ class boolean:
                 raise ValueError(str(val) + " is not bool")
         elif not isinstance(val, bool):
             raise ValueError(str(val) + " is not bool")
-        self._val = val
+        else:
+            self._val = val
     
     def __bool__(self):
         return self._val
@@ -43,20 +52,46 @@ class boolean:
     def __repr__(self):
         return self.__str__()
 
+# local time as ("YYYY-MM-DDTHH:MM", "+HH:MM") by UTC minute
+_minutes = {}
+
+def _local_minute(year, month, day, hour, minute):
+    key = (year, month, day, hour, minute)
+    local = _minutes.get(key)
+    if local is None:
+        text = datetime(year, month, day, hour, minute, tzinfo=timezone.utc).astimezone().isoformat()
+        local = (text[:16], text[19:])
+        if len(_minutes) >= 4096:
+            _minutes.clear()
+        _minutes[key] = local
+    return local
+
 class dateTime(datetime):
+    '''
+    Naive UTC time, formatted in the local timezone with its offset
+    '''
     def __new__(cls, val, *args, **kwargs):
         if isinstance(val, str):
-            date = datetime.strptime(val, "%Y-%m-%dT%H:%M:%S%z")
+            # fromisoformat is much faster, strptime still handles the rest (and Python 3.6)
+            if len(val) == 25 and val[10] == "T" and hasattr(datetime, "fromisoformat"):
+                date = datetime.fromisoformat(val)
+                if date.tzinfo is None:
+                    raise ValueError(val + " has no timezone")
+            else:
+                date = datetime.strptime(val, "%Y-%m-%dT%H:%M:%S%z")
             return datetime.__new__(cls, date.year, date.month, date.day, date.hour, date.minute, date.second, tzinfo=date.tzinfo)
         else:
             return datetime.__new__(cls, val, *args, **kwargs)
     def __str__(self):
-        return self.replace(tzinfo=timezone.utc).astimezone().replace(microsecond=0).isoformat()
+        prefix, offset = _local_minute(self.year, self.month, self.day, self.hour, self.minute)
+        return "%s:%02d%s" % (prefix, self.second, offset)
 
 class CZDICType(str):
-    PATTERN = r"^CZ[0-9]{8,10}$"
+    PATTERN = re.compile(r"^CZ[0-9]{8,10}$")
 
     def __new__(cls, val):
+        if type(val) is cls:
+            return val
         if not isinstance(val, str):
             raise ValueError(str(val) + " is not string")
         if not _pattern(val, cls.PATTERN):
@@ -65,6 +100,8 @@ class CZDICType(str):
 
 class IdProvozType(int):
     def __new__(cls, val):
+        if type(val) is cls:
+            return val
         if not isinstance(val, int):
             raise ValueError(str(val) + " is not int")
         if val < 1 or val > 999999:
@@ -72,9 +109,11 @@ class IdProvozType(int):
         return int.__new__(cls, val)
 
 class string20(str):
-    PATTERN = r"^[0-9a-zA-Z\.,:;/#\-_ ]{1,20}$"
+    PATTERN = re.compile(r"^[0-9a-zA-Z\.,:;/#\-_ ]{1,20}$")
 
     def __new__(cls, val):
+        if type(val) is cls:
+            return val
         if not isinstance(val, str):
             raise ValueError(str(val) + " is not string")
         if not _pattern(val, cls.PATTERN):
@@ -82,28 +121,57 @@ class string20(str):
         return str.__new__(cls, val)
 
 class string25(str):
-    PATTERN = r"^[0-9a-zA-Z\.,:;/#\-_ ]{1,25}$"
+    PATTERN = re.compile(r"^[0-9a-zA-Z\.,:;/#\-_ ]{1,25}$")
 
     def __new__(cls, val):
+        if type(val) is cls:
+            return val
         if not isinstance(val, str):
             raise ValueError(str(val) + " is not string")
         if not _pattern(val, cls.PATTERN):
             raise ValueError(str(val) + " does not match pattern")
         return str.__new__(cls, val)
 
-class CastkaType(float):
+class CastkaType(Decimal):
+    '''
+    Amount in CZK rounded half up to hundredths
+
+    Accepts Decimal, int and float; floats are taken as written
+    (0.005 is 0.005, not its binary approximation).
+    '''
+    _CENT = Decimal("0.01")
+    _LIMIT = Decimal(100000000)
+
     def __new__(cls, val):
-        if not isinstance(val, (int, float)):
+        if type(val) is cls:
+            return val
+        if isinstance(val, float):
+            val = Decimal(repr(val))
+        elif isinstance(val, int):
+            val = Decimal(val)
+        elif not isinstance(val, Decimal):
             raise ValueError("could not convert " + str(val))
-        if val <= -100000000 or val >= 100000000:
+        if not val.is_finite() or abs(val) >= cls._LIMIT:
             raise ValueError(str(val) + " is outside or range")
-        return float.__new__(cls, val)
-    
-    def __str__(self):
-        return "%.2f" % self
+        rounded = val.quantize(cls._CENT, ROUND_HALF_UP)
+        if abs(rounded) >= cls._LIMIT:
+            raise ValueError(str(val) + " is outside or range")
+        return Decimal.__new__(cls, rounded)
+
+    # Decimal pickles and copies itself through str, which is not accepted above
+    def __reduce__(self):
+        return (type(self), (Decimal(self),))
+
+    def __copy__(self):
+        return self
+
+    def __deepcopy__(self, memo):
+        return self
 
 class KodChybaType(int):
     def __new__(cls, val):
+        if type(val) is cls:
+            return val
         if not isinstance(val, int):
             raise ValueError(str(val) + " is not int")
         if val < -999 or val > 999:
@@ -112,6 +180,8 @@ class KodChybaType(int):
 
 class KodVarovType(int):
     def __new__(cls, val):
+        if type(val) is cls:
+            return val
         if not isinstance(val, int):
             raise ValueError(str(val) + " is not int")
         if val < 1 or val > 999:
@@ -120,6 +190,8 @@ class KodVarovType(int):
 
 class RezimType(int):
     def __new__(cls, val):
+        if type(val) is cls:
+            return val
         if not isinstance(val, int):
             raise ValueError(str(val) + " is not int")
         if val != 0 and val != 1:
@@ -127,21 +199,25 @@ class RezimType(int):
         return int.__new__(cls, val)
 
 class BkpType(str):
-    PATTERN = r"^[0-9a-fA-F]{8}-[0-9a-fA-F]{8}-[0-9a-fA-F]{8}-[0-9a-fA-F]{8}-[0-9a-fA-F]{8}$"
+    PATTERN = re.compile(r"^[0-9a-fA-F]{8}-[0-9a-fA-F]{8}-[0-9a-fA-F]{8}-[0-9a-fA-F]{8}-[0-9a-fA-F]{8}$")
 
     def __new__(cls, val):
+        if type(val) is cls:
+            return val
         if not isinstance(val, str):
             raise ValueError(str(val) + " is not string")
         if not _pattern(val, cls.PATTERN):
             raise ValueError(str(val) + " does not match pattern")
         if len(val) != 44:
             raise ValueError(str(val) + " is not 44 chars long")
-        return str.__new__(cls, re.sub(r"\s+", "", val))
+        return str.__new__(cls, _WHITESPACE.sub("", val))
 
 class FikType(str):
-    PATTERN = r"^[0-9a-fA-F]{8}-[0-9a-fA-F]{4}-4[0-9a-fA-F]{3}-[89abAB][0-9a-fA-F]{3}-[0-9a-fA-F]{12}-[0-9a-fA-F]{2}$"
+    PATTERN = re.compile(r"^[0-9a-fA-F]{8}-[0-9a-fA-F]{4}-4[0-9a-fA-F]{3}-[89abAB][0-9a-fA-F]{3}-[0-9a-fA-F]{12}-[0-9a-fA-F]{2}$")
 
     def __new__(cls, val):
+        if type(val) is cls:
+            return val
         if not isinstance(val, str):
             raise ValueError(str(val) + " is not string")
         if not _pattern(val, cls.PATTERN):
@@ -151,11 +227,13 @@ class FikType(str):
         return str.__new__(cls, val)
 
 class PkpType(str):
-    PATTERN = r"^[a-zA-Z0-9+\/]{342}[a-zA-Z0-9+=\/]{2}$"
+    PATTERN = re.compile(r"^[a-zA-Z0-9+\/]{342}[a-zA-Z0-9+=\/]{2}$")
 
     def __new__(cls, val):
+        if type(val) is cls:
+            return val
         if not isinstance(val, str):
             raise ValueError(str(val) + " is not string")
         if not _pattern(val, cls.PATTERN):
             raise ValueError(str(val) + " does not match pattern")
-        return str.__new__(cls, re.sub(r"\s+", "", val))
+        return str.__new__(cls, _WHITESPACE.sub("", val))
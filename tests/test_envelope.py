@@ -0,0 +1,116 @@
+'''
+Soap.build must produce the same bytes as the lxml path it replaced
+
+The envelope is signed, so a single differing byte (an attribute order,
+an escaped character) makes the gateway reject every message.
+
+    python -m unittest discover tests
+'''
+
+import itertools
+import os
+import sys
+import unittest
+import uuid
+
+from datetime import datetime, timedelta
+from decimal import Decimal
+from unittest import mock
+
+from cryptography import x509
+from cryptography.hazmat.backends import default_backend
+from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives.asymmetric import rsa
+from cryptography.x509.oid import NameOID
+from lxml import etree
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from eet import invoices, types
+
+UUIDS = [uuid.UUID("5d0b0c7e-4a2e-4d3b-9c1f-0a1b2c3d4e5f"), uuid.UUID("1f2e3d4c-5b6a-4978-8a7b-6c5d4e3f2a1b")]
+
+
+def _config(dic_poverujiciho=None):
+    key = rsa.generate_private_key(65537, 2048, default_backend())
+    now = datetime.utcnow()
+    cert = (
+        x509.CertificateBuilder()
+        .subject_name(x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, "CZ00000019")]))
+        .issuer_name(x509.Name([
+            x509.NameAttribute(NameOID.COMMON_NAME, "EET CA 1 Playground"),
+            x509.NameAttribute(NameOID.ORGANIZATION_NAME, "Česká Republika – Generální finanční ředitelství")
+        ]))
+        .public_key(key.public_key())
+        .serial_number(x509.random_serial_number())
+        .not_valid_before(now - timedelta(days=1))
+        .not_valid_after(now + timedelta(days=1))
+        .sign(key, hashes.SHA256(), default_backend())
+    )
+    return invoices.Config(cert, key, 141, "1patro", dic_poverujiciho)
+
+
+class EnvelopeTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.config = _config()
+        cls.factory = invoices.Factory(cls.config)
+
+    def invoice(self, *args, **kwargs):
+        invoice = self.factory.new(*args, **kwargs)
+        invoice.sign()
+        invoice.Hlavicka["uuid_zpravy"] = types.UUIDType("0e3a1c5d-7b9f-4e2d-8a6c-4b5d6e7f8091")
+        invoice.Hlavicka["dat_odesl"] = types.dateTime(2019, 8, 11, 8, 0, 5)
+        return invoice
+
+    def assertSameEnvelope(self, invoice, soap=None):
+        soap = soap if soap is not None else self.config.soap()
+        with mock.patch("uuid.uuid4", side_effect=itertools.cycle(UUIDS)):
+            fast = soap.build(invoice)
+        with mock.patch("uuid.uuid4", side_effect=itertools.cycle(UUIDS)):
+            reference = etree.tostring(soap._build_envelope(soap._build_data_element(invoice)))
+        self.assertEqual(fast, reference)
+
+    def test_minimal(self):
+        self.assertSameEnvelope(self.invoice("141-18543-05", 236, types.dateTime(2019, 8, 11, 8, 0, 5)))
+
+    def test_optional_fields(self):
+        amounts = {
+            "zakl_nepodl_dph": 1,
+            "zakl_dan1": Decimal("100.005"),
+            "dan1": 21.0,
+            "zakl_dan2": -3.5,
+            "dan2": 0,
+            "cest_sluz": 99999999.99,
+            "urceno_cerp_zuct": 7,
+            "cerp_zuct": 8
+        }
+        self.assertSameEnvelope(self.invoice("1", -236.5, types.dateTime(2019, 12, 31, 23, 59, 59), **amounts))
+
+    def test_resend(self):
+        invoice = self.invoice("resend", 10)
+        invoice.Hlavicka["prvni_zaslani"] = types.boolean(False)
+        invoice.Hlavicka["overeni"] = types.boolean(True)
+        self.assertSameEnvelope(invoice)
+
+    def test_dic_poverujiciho(self):
+        config = _config("CZ1212121218")
+        invoice = invoices.Factory(config).new("2", 100)
+        invoice.sign()
+        self.assertIn("dic_poverujiciho", invoice.Data.keys())
+        self.assertSameEnvelope(invoice, config.soap())
+
+    def test_escaping(self):
+        # values the types would reject, the builder must still escape them like lxml
+        for text in ('a&b', '<tag>', '"quoted"', "it's", "tab\there", "line\nbreak", "cr\rlf", "é ř ž", "{braces}", "@pkp@"):
+            with self.subTest(text=text):
+                invoice = self.invoice("3", 1)
+                invoice.Data["id_pokl"] = text
+                invoice.Data["porad_cis"] = text
+                invoice.Codes["bkp"] = text
+                self.assertSameEnvelope(invoice)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,31 @@
+'''
+Modules listed in the import time budgets must not load what they forbid
+
+Only the loaded modules are checked, the time depends on the machine; see
+benchmarks/importtime.py for both.
+
+    python -m unittest discover tests
+'''
+
+import os
+import sys
+import unittest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, "benchmarks"))
+
+import importtime
+
+
+class ImportTest(unittest.TestCase):
+
+    def test_forbidden_modules(self):
+        for module, (budget, forbidden) in importtime.BUDGETS.items():
+            with self.subTest(module=module):
+                _, loaded = importtime.measure(module)
+                self.assertIn(module, loaded)
+                self.assertEqual(sorted(name for name in forbidden if name in loaded), [])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,50 @@
+'''
+Amounts must survive pickling and copying, new_many sends them to worker processes
+
+    python -m unittest discover tests
+'''
+
+import copy
+import os
+import pickle
+import sys
+import unittest
+
+from decimal import Decimal
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from eet import invoices, types
+
+from test_envelope import _config
+
+
+class CastkaTypeTest(unittest.TestCase):
+
+    def assertSameAmount(self, copied, amount):
+        self.assertIs(type(copied), types.CastkaType)
+        self.assertEqual(copied, amount)
+        self.assertEqual(str(copied), str(amount))
+
+    def test_pickle(self):
+        for value in (236, -0.5, Decimal("100.005"), Decimal("99999999.99")):
+            with self.subTest(value=value):
+                amount = types.CastkaType(value)
+                for protocol in range(pickle.HIGHEST_PROTOCOL + 1):
+                    self.assertSameAmount(pickle.loads(pickle.dumps(amount, protocol)), amount)
+
+    def test_copy(self):
+        amount = types.CastkaType(1.5)
+        self.assertSameAmount(copy.copy(amount), amount)
+        self.assertSameAmount(copy.deepcopy({"celk_trzba": amount})["celk_trzba"], amount)
+
+    def test_new_many(self):
+        factory = invoices.Factory(_config())
+        specs = [{"porad_cis": str(i), "celk_trzba": types.CastkaType(i + 0.25)} for i in range(3)]
+        signed = list(factory.new_many(specs, workers=2))
+        self.assertEqual([invoice.Data["celk_trzba"] for invoice, _ in signed], [Decimal("0.25"), Decimal("1.25"), Decimal("2.25")])
+
+
+if __name__ == "__main__":
+    unittest.main()